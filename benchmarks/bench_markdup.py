@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+'''Compares run time and peak memory of capsid markdup against Picard MarkDuplicates on the same BAM'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import pysam
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+READ_LENGTH = 100
+
+
+def random_bam(path, pairs, duplication, seed):
+    '''Writes a coordinate sorted BAM of read pairs, a fraction of them copies of earlier pairs'''
+
+    rng = random.Random(seed)
+    length = max(pairs * 10, 100000)
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': length}],
+              'RG': [{'ID': 'rg1', 'LB': 'lib1', 'SM': 'sample1'}]}
+
+    fragments = []
+    for i in xrange(pairs):
+        if fragments and rng.random() < duplication:
+            fragments.append(rng.choice(fragments))
+        else:
+            start = rng.randint(0, length - 1000)
+            fragments.append((start, start + rng.randint(200, 600)))
+
+    reads = []
+    for i, (start, end) in enumerate(fragments):
+        reads.append((start, 'p{0}'.format(i), 99, end - READ_LENGTH, 1))
+        reads.append((end - READ_LENGTH, 'p{0}'.format(i), 147, start, -1))
+    reads.sort()
+
+    out = pysam.Samfile(path, 'wb', header=header)
+    for pos, qname, flag, mpos, sign in reads:
+        read = pysam.AlignedRead()
+        read.qname = qname
+        read.flag = flag
+        read.tid = read.rnext = 0
+        read.pos = pos
+        read.pnext = mpos
+        read.mapq = 60
+        read.cigar = [(0, READ_LENGTH)]
+        read.tlen = sign * (abs(mpos - pos) + READ_LENGTH)
+        read.seq = ''.join(rng.choice('ACGT') for j in xrange(READ_LENGTH))
+        read.qual = ''.join(chr(33 + rng.randint(10, 40)) for j in xrange(READ_LENGTH))
+        read.tags = [('RG', 'rg1'), ('MC', '{0}M'.format(READ_LENGTH))]
+        out.write(read)
+    out.close()
+
+    return len(reads)
+
+
+def measure(command):
+    '''Runs command through this script, so the peak RSS reported is only that of the command'''
+
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--measure', '--'] + command)
+    return json.loads(output)
+
+
+def run_measured(command):
+    start = time.time()
+    status = subprocess.call(command, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    seconds = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+
+    print json.dumps({'status': status, 'seconds': seconds, 'peak_rss_mb': rss})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Duplicate marking benchmark')
+    parser.add_argument('--pairs', type=int, default=500000, help='Read pairs in the generated BAM [500000]')
+    parser.add_argument('--duplication', type=float, default=0.2, help='Fraction of duplicate pairs [0.2]')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('--bam', default=None, help='Use this coordinate sorted BAM instead of a generated one')
+    parser.add_argument('--picard', metavar='JAR', default=None, help='Path of MarkDuplicates.jar (or picard.jar) to compare against')
+    parser.add_argument('--java-options', dest='java_options', default='-Xmx4g', help='Options for the Picard JVM [-Xmx4g]')
+    parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('command', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        run_measured(args.command[1:] if args.command[:1] == ['--'] else args.command)
+        return
+
+    directory = tempfile.mkdtemp(prefix='bench_markdup')
+    bam = args.bam
+    if bam is None:
+        bam = os.path.join(directory, 'input.bam')
+        random_bam(bam, args.pairs, args.duplication, args.seed)
+    # Counted by reading the file, .mapped needs an index the generated BAM does not have
+    bamfile = pysam.Samfile(bam, 'rb')
+    reads = sum(1 for read in bamfile.fetch(until_eof=True))
+    bamfile.close()
+
+    native = [sys.executable, '-c',
+              'import sys; sys.path.insert(0, {0!r}); from capsid import markdup; markdup.mark_duplicates({1!r}, {2!r}, metrics_file={3!r})'.format(
+                  ROOT, bam, os.path.join(directory, 'native.bam'), os.path.join(directory, 'native.metrics'))]
+    results = [dict(measure(native), tool='capsid markdup')]
+
+    if args.picard:
+        picard = ['java'] + args.java_options.split() + ['-jar', args.picard]
+        if os.path.basename(args.picard) == 'picard.jar':
+            picard.append('MarkDuplicates')
+        picard += ['INPUT=' + bam, 'OUTPUT=' + os.path.join(directory, 'picard.bam'),
+                   'METRICS_FILE=' + os.path.join(directory, 'picard.metrics'),
+                   'ASSUME_SORTED=true', 'VALIDATION_STRINGENCY=LENIENT']
+        results.append(dict(measure(picard), tool='picard MarkDuplicates'))
+
+    for result in results:
+        result['reads_per_second'] = reads / result['seconds'] if result['seconds'] else None
+
+    print json.dumps({'bam': bam, 'reads': reads, 'scratch': directory, 'results': results}, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+'''Compares load and export times of 80 byte GridFS chunks against the chunked sequence store'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+from pymongo import MongoClient
+import gridfs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from capsid.seqstore import SequenceStore, ENCODINGS
+
+
+def random_genome(length, seed):
+    '''Deterministic random sequence with a sprinkling of N runs'''
+
+    rng = random.Random(seed)
+    seq = bytearray(rng.choice('ACGT') for i in xrange(length))
+    for i in xrange(length // 100000):
+        start = rng.randint(0, length - 100)
+        seq[start:start + 100] = 'N' * 100
+
+    return str(seq)
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def bench_gridfs(db, gi, seq):
+    fs = gridfs.GridFS(db)
+    load, file_id = timed(lambda: fs.put(seq, filename=str(gi), chunkSize=80))
+    export, size = timed(lambda: sum(len('{0}\n'.format(line)) for line in fs.get_last_version(str(gi))))
+    chunks = db.fs.chunks.find({'files_id': file_id}).count()
+
+    return {'store': 'gridfs', 'encoding': 'raw', 'load': load, 'export': export, 'chunks': chunks}
+
+
+def bench_store(db, gi, seq, encoding):
+    store = SequenceStore(db)
+    load, _ = timed(store.put, gi, seq, encoding)
+    export, size = timed(lambda: sum(len(block) for block in store.wrap(gi)))
+    region, _ = timed(store.get, gi, len(seq) // 2, len(seq) // 2 + 1000)
+    stats = db.command('collstats', 'sequence')
+    chunks = db.sequence.find({'genome': gi}).count()
+    db.sequence.remove({'genome': gi})
+
+    return {'store': 'sequence', 'encoding': encoding, 'load': load, 'export': export,
+            'region': region, 'chunks': chunks, 'bytes': stats['size']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sequence storage benchmark')
+    parser.add_argument('--host', default='localhost', help='MongoDB Server address')
+    parser.add_argument('--port', type=int, default=27017, help='Port used to connect to MongoDB')
+    parser.add_argument('--database', default='capsid_benchmark', help='Scratch database, dropped afterwards')
+    parser.add_argument('--length', type=int, default=5000000, help='Genome length in bases [5000000]')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    args = parser.parse_args()
+
+    client = MongoClient(args.host, args.port)
+    client.drop_database(args.database)
+    db = client[args.database]
+
+    seq = random_genome(args.length, args.seed)
+    results = [bench_gridfs(db, 1, seq)] + [bench_store(db, 2, seq, encoding) for encoding in ENCODINGS]
+
+    client.drop_database(args.database)
+    print json.dumps({'length': args.length, 'results': results}, indent=2)
+
+
+if __name__ == '__main__':
+    main()
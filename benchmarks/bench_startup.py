@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+'''
+Measures how long the capsid command takes to start for each subcommand: the time for
+`capsid <command> -h`, which builds the parser, and the time for a fresh interpreter to
+import the module the subcommand runs. Metadata commands, register and pipeline should stay
+well under 100 ms.
+
+Time byte compiled modules, as an installed capsid and its dependencies are. Without .pyc
+files the import times are mostly spent compiling pymongo.
+'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CAPSID = os.path.join(ROOT, 'bin', 'capsid')
+# bin/capsid runs against this checkout rather than an installed capsid
+ENVIRONMENT = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+
+# Subcommand and the module it runs
+COMMANDS = [('project', 'project'), ('sample', 'sample'), ('alignment', 'alignment'), ('configure', 'configure'),
+            ('qfilter', 'qfilter'), ('intersect', 'intersect'), ('fasta', 'fasta'), ('gbloader', 'gbloader'),
+            ('migrate', 'seqstore'), ('taxonomy', 'taxonomy'), ('sam2bam', 'sam2bam'), ('markdup', 'markdup'),
+            ('subtraction', 'subtraction'), ('statistics', 'statistics'), ('register', 'register'),
+            ('pipeline', 'pipeline'), ('mapped', 'mapped')]
+# Commands a workflow engine calls many times, each should start well under TARGET_MS
+METADATA = ['project', 'sample', 'alignment', 'register', 'pipeline']
+TARGET_MS = 100
+HEAVY = ['pysam', 'Bio', 'bx', 'numpy', 'gridfs']
+
+IMPORT = '''
+import sys, time, json
+start = time.time()
+sys.path.insert(0, {0!r})
+import capsid
+from capsid import {1}
+seconds = time.time() - start
+print json.dumps({{'seconds': seconds, 'heavy': [m for m in {2!r} if m in sys.modules]}})
+'''
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def time_command(command, runs):
+    '''Median wall clock milliseconds of running command'''
+
+    times = []
+    for i in xrange(runs):
+        start = time.time()
+        subprocess.check_call(command, stdout=open(os.devnull, 'w'), env=ENVIRONMENT)
+        times.append(time.time() - start)
+    return round(1000 * median(times), 1)
+
+
+def time_import(module, runs):
+    '''Median milliseconds a fresh interpreter takes to import capsid and module, and the heavy modules it loaded'''
+
+    results = []
+    for i in xrange(runs):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT.format(ROOT, module, HEAVY)], stderr=open(os.devnull, 'w'))
+        results.append(json.loads(output))
+    return round(1000 * median([r['seconds'] for r in results]), 1), results[0]['heavy']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='capsid startup time benchmark')
+    parser.add_argument('--runs', type=int, default=11, help='Runs of each measurement, the median is reported [11]')
+    args = parser.parse_args()
+
+    interpreter = time_command([sys.executable, '-c', 'pass'], args.runs)
+    results = []
+    for command, module in COMMANDS:
+        try:
+            import_ms, heavy = time_import(module, args.runs)
+        except subprocess.CalledProcessError:
+            # A missing optional dependency such as bx-python
+            import_ms, heavy = None, None
+        results.append({
+            'command': command
+            , 'helpMs': time_command([sys.executable, CAPSID, command, '-h'], args.runs)
+            , 'importMs': import_ms
+            , 'heavyModules': heavy
+            })
+
+    metadata = [r for r in results if r['command'] in METADATA]
+    print json.dumps({
+        'interpreterMs': interpreter
+        , 'targetMs': TARGET_MS
+        , 'metadataWithinTarget': all(r['helpMs'] < TARGET_MS and r['importMs'] < TARGET_MS for r in metadata)
+        , 'results': results
+        }, indent=2)
+
+
+if __name__ == '__main__':
+    main()
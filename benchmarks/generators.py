@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+'''Deterministic synthetic BAM, FASTQ and GenBank data for the benchmarks'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+
+from Bio import SeqIO
+from Bio.Alphabet import generic_dna
+from Bio.Seq import Seq
+from Bio.SeqFeature import SeqFeature, FeatureLocation
+from Bio.SeqRecord import SeqRecord
+import pysam
+
+
+# Synthetic genomes are numbered from here, well away from real GIs
+FIRST_GI = 900000001
+HUMAN_LENGTH = 10000000
+
+
+def genome_header(gi):
+    '''Reference name in the gi|...|ref|...| form subtraction extracts the GI from'''
+
+    return 'gi|{0}|ref|NC_{1:06d}.1|'.format(gi, gi - FIRST_GI + 1)
+
+
+def genome_documents(genomes, length, genes, seed=1):
+    '''Genome and gene feature documents matching the references of random_bams'''
+
+    rng = random.Random(seed)
+    genome_docs, feature_docs = [], []
+
+    for gi in xrange(FIRST_GI, FIRST_GI + genomes):
+        genome_docs.append({
+            "gi": gi
+            , "name": 'Synthetic virus {0}, complete genome'.format(gi)
+            , "accession": 'NC_{0:06d}'.format(gi - FIRST_GI + 1)
+            , "version": 1
+            , "length": length
+            , "strand": 1
+            , "taxonomy": ['Viruses', 'Synthetic']
+            , "organism": 'Synthetic virus {0}'.format(gi)
+            })
+        for i in xrange(genes):
+            start = rng.randint(1, length - 1000)
+            end = start + rng.randint(300, 999)
+            feature_docs.append({
+                "name": 'gene{0}'.format(i)
+                , "uid": 'gene{0}-{1}-{2}-{3}-{4}'.format(i, gi, i, start, end)
+                , "genome": gi
+                , "geneId": i
+                , "locusTag": 'L{0}'.format(i)
+                , "start": start
+                , "end": end
+                , "operator": None
+                , "strand": 1
+                , "type": 'gene'
+                })
+
+    return genome_docs, feature_docs
+
+
+def qualities(rng, length, mean=30, sd=8):
+    '''Phred+33 quality string with normally distributed scores between 2 and 41'''
+
+    return ''.join(chr(33 + min(41, max(2, int(rng.gauss(mean, sd))))) for i in xrange(length))
+
+
+def bases(rng, length):
+    return ''.join(rng.choice('ACGT') for i in xrange(length))
+
+
+def make_read(rng, qname, flag, tid, pos, mtid, mpos, length):
+    read = pysam.AlignedRead()
+    read.qname = qname
+    read.flag = flag
+    read.tid = tid
+    read.pos = pos
+    read.rnext = mtid
+    read.pnext = mpos
+    read.mapq = 0 if flag & 0x4 else 60
+    read.seq = bases(rng, length)
+    read.qual = qualities(rng, length)
+    if not flag & 0x4:
+        read.cigar = [(0, length)]
+        read.tags = [('AS', rng.randint(length // 2, length * 2)), ('MD', str(length))]
+
+    return read
+
+
+def random_bams(xeno_file, ref_file, pairs, overlap=0.2, genomes=10, length=50000, read_length=100, seed=1):
+    '''
+    Writes a xeno BAM with every read pair properly mapped to one of the synthetic genomes,
+    and a reference BAM where a fraction overlap of the same pairs map to human and the
+    rest are unmapped. Both are in read name order, as they come out of an aligner.
+    '''
+
+    rng = random.Random(seed)
+    xeno_header = {'HD': {'VN': '1.0', 'SO': 'unsorted'},
+                   'SQ': [{'SN': genome_header(gi), 'LN': length} for gi in xrange(FIRST_GI, FIRST_GI + genomes)]}
+    ref_header = {'HD': {'VN': '1.0', 'SO': 'unsorted'}, 'SQ': [{'SN': 'chr1', 'LN': HUMAN_LENGTH}]}
+
+    xeno = pysam.Samfile(xeno_file, 'wb', header=xeno_header)
+    ref = pysam.Samfile(ref_file, 'wb', header=ref_header)
+
+    for i in xrange(pairs):
+        qname = 'read{0:09d}'.format(i)
+
+        tid = rng.randrange(genomes)
+        pos = rng.randint(0, length - 2 * read_length - 500)
+        mpos = pos + rng.randint(read_length, 500)
+        xeno.write(make_read(rng, qname + '/1', 99, tid, pos, tid, mpos, read_length))
+        xeno.write(make_read(rng, qname + '/2', 147, tid, mpos, tid, pos, read_length))
+
+        if rng.random() < overlap:
+            pos = rng.randint(0, HUMAN_LENGTH - 1000)
+            mpos = pos + rng.randint(read_length, 500)
+            ref.write(make_read(rng, qname + '/1', 99, 0, pos, 0, mpos, read_length))
+            ref.write(make_read(rng, qname + '/2', 147, 0, mpos, 0, pos, read_length))
+        else:
+            ref.write(make_read(rng, qname + '/1', 77, -1, -1, -1, -1, read_length))
+            ref.write(make_read(rng, qname + '/2', 141, -1, -1, -1, -1, read_length))
+
+    xeno.close()
+    ref.close()
+
+
+def random_reference_bam(ref_file, pairs, xeno=0.02, unmapped=0.05, genomes=10, length=50000, read_length=100, seed=1):
+    '''
+    Writes a reference BAM as subtraction usually sees one: most pairs map to human, a fraction
+    xeno also map to the xeno genomes (and to a synthetic genome in the reference) and a
+    fraction unmapped map nowhere. Returns the read ids of the xeno pairs.
+    '''
+
+    rng = random.Random(seed)
+    header = {'HD': {'VN': '1.0', 'SO': 'unsorted'},
+              'SQ': [{'SN': 'chr1', 'LN': HUMAN_LENGTH}] + [{'SN': genome_header(gi), 'LN': length} for gi in xrange(FIRST_GI, FIRST_GI + genomes)]}
+    ref = pysam.Samfile(ref_file, 'wb', header=header)
+    readids = set()
+
+    for i in xrange(pairs):
+        qname = 'read{0:09d}'.format(i)
+        r = rng.random()
+
+        if r < unmapped:
+            ref.write(make_read(rng, qname + '/1', 77, -1, -1, -1, -1, read_length))
+            ref.write(make_read(rng, qname + '/2', 141, -1, -1, -1, -1, read_length))
+            continue
+
+        if r < unmapped + xeno:
+            readids.add(qname)
+            tid, chromosome_length = rng.randint(1, genomes), length
+        else:
+            tid, chromosome_length = 0, HUMAN_LENGTH
+        pos = rng.randint(0, chromosome_length - 2 * read_length - 500)
+        mpos = pos + rng.randint(read_length, 500)
+        ref.write(make_read(rng, qname + '/1', 99, tid, pos, tid, mpos, read_length))
+        ref.write(make_read(rng, qname + '/2', 147, tid, mpos, tid, pos, read_length))
+
+    ref.close()
+
+    return readids
+
+
+def random_fastq(path, reads, read_length=100, mean=30, sd=8, seed=1, pair_path=None):
+    '''Writes FASTQ (and its mate file) with qualities drawn from a normal distribution'''
+
+    rng = random.Random(seed)
+    outputs = [open(path, 'w')] + ([open(pair_path, 'w')] if pair_path else [])
+
+    for i in xrange(reads):
+        for n, fh in enumerate(outputs):
+            name = 'read{0:09d}/{1}'.format(i, n + 1)
+            fh.write('@{0}\n{1}\n+\n{2}\n'.format(name, bases(rng, read_length), qualities(rng, read_length, mean, sd)))
+
+    for fh in outputs:
+        fh.close()
+
+
+def random_genbank(path, genomes, genes, length=20000, seed=1):
+    '''Writes a GenBank file of synthetic genomes, each with genes gene and CDS features'''
+
+    rng = random.Random(seed)
+
+    def records():
+        for gi in xrange(FIRST_GI, FIRST_GI + genomes):
+            accession = 'NC_{0:06d}'.format(gi - FIRST_GI + 1)
+            organism = 'Synthetic virus {0}'.format(gi)
+            record = SeqRecord(Seq(bases(rng, length), generic_dna), id=accession + '.1', name=accession,
+                               description=organism + ', complete genome')
+            record.annotations.update({'gi': str(gi), 'sequence_version': 1, 'organism': organism,
+                                       'taxonomy': ['Viruses', 'Synthetic'], 'data_file_division': 'VRL',
+                                       'date': '01-JAN-2015', 'molecule_type': 'DNA'})
+            record.features.append(SeqFeature(FeatureLocation(0, length), strand=1, type='source',
+                                              qualifiers={'organism': [organism]}))
+            for i in xrange(genes):
+                start = rng.randint(0, length - 1000)
+                end = start + rng.randint(300, 999)
+                qualifiers = {'gene': ['gene{0}'.format(i)], 'locus_tag': ['L{0}'.format(i)], 'db_xref': ['GeneID:{0}'.format(i)]}
+                for feature_type in ('gene', 'CDS'):
+                    record.features.append(SeqFeature(FeatureLocation(start, end), strand=1, type=feature_type, qualifiers=qualifiers))
+            yield record
+
+    SeqIO.write(records(), path, 'gb')
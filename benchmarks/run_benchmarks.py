@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+'''
+Runs the core of subtraction, statistics, qfilter, intersect and gbloader on synthetic data
+and reports throughput, peak memory and MongoDB round trips as JSON. parse_ref times the
+reference BAM pass of subtraction alone, on a BAM where most reads map to human only.
+
+    python benchmarks/run_benchmarks.py --scale 2 > results.json
+
+Uses the mongod at --host/--port when there is one, mongomock otherwise (or with --mongomock).
+Each benchmark runs in its own process so the peak RSS figures do not include the others.
+'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import defaultdict
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pymongo
+from pymongo.errors import ConnectionFailure
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import generators
+
+
+BENCHMARKS = ['subtraction', 'parse_ref', 'statistics', 'qfilter', 'intersect', 'gbloader']
+
+# Collection methods that go to the server. A find is counted once, however many batches it reads.
+OPERATIONS = set(['find', 'find_one', 'insert', 'save', 'update', 'remove', 'count', 'distinct',
+                  'aggregate', 'find_and_modify', 'ensure_index', 'drop', 'rename'])
+BULK_OPERATIONS = set(['initialize_ordered_bulk_op', 'initialize_unordered_bulk_op'])
+
+
+class CountingBulk(object):
+    def __init__(self, bulk, counts, name):
+        self.bulk, self.counts, self.name = bulk, counts, name
+
+    def __getattr__(self, attr):
+        return getattr(self.bulk, attr)
+
+    def execute(self, *args, **kwargs):
+        self.counts[self.name + '.bulk'] += 1
+        return self.bulk.execute(*args, **kwargs)
+
+
+class CountingCollection(object):
+    '''Forwards to a collection, counting the calls that make a round trip'''
+
+    def __init__(self, collection, counts):
+        self.collection = collection
+        self.counts = counts
+        # mongomock's find has no timeout option
+        self.mock = not isinstance(collection, pymongo.collection.Collection)
+
+    def __getattr__(self, attr):
+        value = getattr(self.collection, attr)
+        name = self.collection.name
+
+        if attr in OPERATIONS:
+            def counted(*args, **kwargs):
+                self.counts[name + '.' + attr] += 1
+                if self.mock:
+                    kwargs.pop('timeout', None)
+                return value(*args, **kwargs)
+            return counted
+        if attr in BULK_OPERATIONS:
+            return lambda: CountingBulk(value(), self.counts, name)
+
+        return value
+
+
+class CountingDatabase(object):
+    '''Forwards to a database, handing out counting collections'''
+
+    def __init__(self, db):
+        self.db = db
+        self.counts = defaultdict(int)
+
+    def __getitem__(self, name):
+        return CountingCollection(self.db[name], self.counts)
+
+    def __getattr__(self, name):
+        if name == 'command':
+            def command(*args, **kwargs):
+                self.counts['command'] += 1
+                return self.db.command(*args, **kwargs)
+            return command
+        if hasattr(type(self.db), name):
+            return getattr(self.db, name)
+
+        return self[name]
+
+
+class NoGridFS(object):
+    '''mongomock has no GridFS, the sequence store only needs it for genomes loaded before 1.7'''
+
+    def exists(self, *args, **kwargs):
+        return False
+
+    def find(self, *args, **kwargs):
+        return []
+
+
+def get_database(args, name):
+    '''Returns a scratch database on the mongod, or a mongomock one, and the backend name'''
+
+    if not args.mongomock:
+        try:
+            client = pymongo.MongoClient(args.host, args.port, connectTimeoutMS=1000)
+            client.drop_database(name)
+            return client[name], 'mongod'
+        except ConnectionFailure:
+            pass
+
+    import mongomock
+    return mongomock.MongoClient()[name], 'mongomock'
+
+
+def namespace(**kwargs):
+    return argparse.Namespace(logging=logging, **kwargs)
+
+
+def load_metadata(db):
+    '''Creates the project, sample and alignment the synthetic reads belong to'''
+
+    project_id = db.project.insert({'label': 'bench', 'name': 'bench', 'roles': ['ROLE_bench'], 'version': 0})
+    sample_id = db.sample.insert({'name': 'sample1', 'projectId': project_id, 'projectLabel': 'bench', 'version': 0})
+    db.alignment.insert({'name': 'aln1', 'projectId': project_id, 'projectLabel': 'bench', 'sample': 'sample1',
+                         'sampleId': sample_id, 'platform': 'Illumina', 'type': 'Paired End', 'version': 0})
+
+
+def load_genomes(db, genomes, genes):
+    genome_docs, feature_docs = generators.genome_documents(genomes, 50000, genes)
+    db.genome.insert(genome_docs)
+    db.feature.insert(feature_docs)
+
+
+def setup_subtraction(db, workdir, scale):
+    '''Writes the BAMs and loads the genomes, returns the subtraction arguments and number of pairs'''
+
+    pairs = 5000 * scale
+    xeno, ref = os.path.join(workdir, 'xeno.bam'), os.path.join(workdir, 'ref.bam')
+    generators.random_bams(xeno, ref, pairs)
+    load_genomes(db, 10, 20)
+    load_metadata(db)
+
+    args = namespace(xeno=xeno, ref=ref, align='aln1', sample='sample1', project='bench', process='mapped',
+                     filter=0, temp=workdir + '/', gra=False, lookup=None,
+                     xeno_lookup=[None, None], ref_lookup=[None, None], compact=False, sidecar=None)
+    return args, pairs
+
+
+def bench_subtraction(db, workdir, scale):
+    from capsid import subtraction
+
+    args, pairs = setup_subtraction(db, workdir, scale)
+    counting = CountingDatabase(db)
+    subtraction.connect = lambda args: counting
+
+    return lambda: subtraction.main(args), 2 * pairs, 'alignments', counting
+
+
+def bench_parse_ref(db, workdir, scale):
+    from capsid import subtraction
+
+    # Only reading the reference BAM, mapped reads are built but not inserted
+    pairs = 50000 * scale
+    ref = os.path.join(workdir, 'ref.bam')
+    readids = generators.random_reference_bam(ref, pairs)
+    load_genomes(db, 10, 20)
+    load_metadata(db)
+
+    counting = CountingDatabase(db)
+    subtraction.db = counting
+    subtraction.logger = logging.getLogger('subtraction')
+    subtraction.meta = subtraction.get_meta(namespace(align='aln1', sample='sample1', project='bench'))
+    subtraction.mapq, subtraction.gra, subtraction.temp = 0, False, workdir + '/'
+
+    none = subtraction.Lookup(None, None)
+    args = namespace(ref=ref, gra=False, lookup=subtraction.LookupGroup(none, none))
+    fastq = subtraction.UnmappedWriter(workdir, 'aln1')
+
+    def run():
+        for mapped in subtraction.parse_ref(args, readids, 'both', fastq):
+            pass
+        fastq.close()
+
+    return run, 2 * pairs, 'alignments', counting
+
+
+def bench_statistics(db, workdir, scale):
+    from capsid import subtraction, statistics
+
+    # subtraction loads the mapped reads, only the statistics are measured
+    args, pairs = setup_subtraction(db, workdir, scale)
+    subtraction.connect = lambda args: db
+    subtraction.main(args)
+
+    counting = CountingDatabase(db)
+    statistics.db = counting
+    statistics.logger = logging.getLogger('statistics')
+    statistics.filter_bg = False
+
+    project = db.project.find_one({'label': 'bench'})
+    samples = list(db.sample.find({'projectId': project['_id']}))
+    alignments = list(db.alignment.find({'projectId': project['_id']}))
+    genomes = db.genome.find().count()
+
+    def run():
+        [statistics.sample_statistics(sample, project) for sample in samples]
+        [statistics.alignment_statistics(alignment, project) for alignment in alignments]
+        statistics.project_statistics(project)
+        [statistics.update_sample_count(genome) for genome in db.genome.find({}, {'_id': 0, 'gi': 1})]
+
+    return run, genomes * (len(samples) + len(alignments) + 1), 'statistics', counting
+
+
+def bench_qfilter(db, workdir, scale):
+    from capsid import qfilter
+
+    reads = 20000 * scale
+    single, pair = os.path.join(workdir, 'reads_1.fastq'), os.path.join(workdir, 'reads_2.fastq')
+    generators.random_fastq(single, reads, mean=28, sd=10, pair_path=pair)
+
+    args = namespace(single=single, pair=pair, threshold=20, limit=3, format='sanger', temp=workdir)
+    return lambda: qfilter.main(args), reads, 'records', CountingDatabase(db)
+
+
+def bench_intersect(db, workdir, scale):
+    from capsid import intersect
+
+    # The same seed gives the same leading reads, so each file overlaps the next
+    reads = 20000 * scale
+    files = []
+    for n, fraction in enumerate([1.0, 0.8, 0.6]):
+        files.append(os.path.join(workdir, 'unmapped{0}.fastq'.format(n)))
+        generators.random_fastq(files[-1], int(reads * fraction))
+
+    os.chdir(workdir)
+    args = namespace(files=files, temp=workdir)
+    return lambda: intersect.main(args), int(reads * 2.4), 'records', CountingDatabase(db)
+
+
+def bench_gbloader(db, workdir, scale):
+    from capsid import gbloader
+    from capsid.seqstore import SequenceStore
+    import gridfs
+
+    genomes = 20 * scale
+    path = os.path.join(workdir, 'synthetic.gbff')
+    generators.random_genbank(path, genomes, 50)
+
+    counting = CountingDatabase(db)
+    store = SequenceStore.__new__(SequenceStore)
+    store.collection = counting.sequence
+    store.fs = gridfs.GridFS(db) if isinstance(db, pymongo.database.Database) else NoGridFS()
+
+    gbloader.db = counting
+    gbloader.store = store
+    gbloader.encoding = '2bit'
+    gbloader.logger = logging.getLogger('gbloader')
+
+    return lambda: gbloader.parse_gb_file(path, False), genomes, 'genomes', counting
+
+
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def run_child(args):
+    '''Runs one benchmark in this process and prints its result'''
+
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix='capsid_bench_')
+    db, backend = get_database(args, 'capsid_bench_' + args.child)
+
+    try:
+        run, items, unit, counting = globals()['bench_' + args.child](db, workdir, args.scale)
+
+        start = time.time()
+        run()
+        seconds = time.time() - start
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+        if backend == 'mongod':
+            db.connection.drop_database(db.name)
+
+    print json.dumps({
+        'name': args.child
+        , 'backend': backend
+        , 'seconds': round(seconds, 3)
+        , 'items': items
+        , 'unit': unit
+        , 'rate': round(items / seconds, 1) if seconds else None
+        , 'peakRssMb': round(peak_rss(), 1)
+        , 'roundTrips': sum(counting.counts.itervalues())
+        , 'operations': dict(counting.counts)
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CaPSID benchmark suite')
+    parser.add_argument('benchmarks', nargs='*', metavar='NAME', help='Benchmarks to run, any of {0} [all]'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--scale', type=int, default=1, help='Multiplies the size of the generated data [1]')
+    parser.add_argument('--host', default='localhost', help='MongoDB Server address')
+    parser.add_argument('--port', type=int, default=27017, help='Port used to connect to MongoDB')
+    parser.add_argument('--mongomock', action='store_true', help='Use mongomock even if a mongod is running')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: {0}'.format(', '.join(sorted(unknown))))
+
+    options = ['--scale', str(args.scale), '--host', args.host, '--port', str(args.port)]
+    if args.mongomock:
+        options.append('--mongomock')
+
+    results = []
+    for name in args.benchmarks or BENCHMARKS:
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', name] + options)
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    import capsid
+    print json.dumps({'version': capsid.__version__, 'scale': args.scale, 'results': results}, indent=2)
+
+
+if __name__ == '__main__':
+    main()
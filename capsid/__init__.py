@@ -12,7 +12,8 @@
 import logging, logging.handlers
 import os, sys, errno, ConfigParser
 
-import configure, qfilter, gbloader, subtraction, statistics, fasta, intersect, project, sample, alignment, taxonomy
+# Submodules are imported by the subcommand that uses them, see bin/capsid
+import instrument
 
 
 def chunks(l, n):
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+'''BGZF (blocked gzip) writer with parallel block compression and .gzi index output'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from functools import partial
+from multiprocessing.pool import ThreadPool
+import struct
+import zlib
+
+
+# Largest uncompressed block, leaves room for incompressible data in a 64 KB block
+MAX_BLOCK = 0xff00
+# Number of blocks handed to the compression threads at a time
+BATCH = 64
+EOF = '1f8b08040000000000ff0600424302001b0003000000000000000000'.decode('hex')
+
+
+def compress_block(data, level=6):
+    '''Returns one BGZF block holding data'''
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+
+    # gzip header with the BC extra field, BSIZE is the total block size - 1
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class BgzfWriter(object):
+    '''
+    File-like writer for BGZF files, readable by gzip, samtools and pysam.
+    zlib releases the GIL, so blocks are compressed in parallel when threads > 1.
+    tell() returns the uncompressed offset, which is what .fai files refer to.
+    '''
+
+    def __init__(self, path, threads=1, level=6):
+        self.fh = open(path, 'wb')
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.compress = partial(compress_block, level=level)
+        self.parts = []
+        self.size = 0
+        self.offset = 0
+        self.compressed_offset = 0
+        self.uncompressed_offset = 0
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        self.offset += len(data)
+
+        if self.size >= MAX_BLOCK * BATCH:
+            self.flush_blocks(final=False)
+
+    def tell(self):
+        return self.offset
+
+    def flush_blocks(self, final):
+        '''Compresses and writes all full blocks, and the partial last block if final'''
+
+        data = ''.join(self.parts)
+        cut = len(data) if final else len(data) - len(data) % MAX_BLOCK
+        blocks = [data[i:i + MAX_BLOCK] for i in xrange(0, cut, MAX_BLOCK)]
+
+        self.parts = [data[cut:]] if cut < len(data) else []
+        self.size = len(data) - cut
+
+        compressed = self.pool.map(self.compress, blocks) if self.pool else map(self.compress, blocks)
+        for raw, block in zip(blocks, compressed):
+            self.blocks.append((self.compressed_offset, self.uncompressed_offset))
+            self.fh.write(block)
+            self.compressed_offset += len(block)
+            self.uncompressed_offset += len(raw)
+
+    def close(self):
+        if self.fh.closed:
+            return
+
+        self.flush_blocks(final=True)
+        self.fh.write(EOF)
+        self.fh.close()
+        if self.pool:
+            self.pool.close()
+
+    def write_gzi(self, path):
+        '''Writes the .gzi index of block offsets used by samtools faidx and pysam'''
+
+        # The first block always starts at (0, 0) so, like htslib, it is left out
+        offsets = self.blocks[1:]
+        with open(path, 'wb') as fh:
+            fh.write(struct.pack('<Q', len(offsets)))
+            [fh.write(struct.pack('<QQ', compressed, uncompressed)) for compressed, uncompressed in offsets]
@@ -74,6 +74,10 @@ def ensure_indexes():
     db.statistics.ensure_index('ownerId')
     db.statistics.ensure_index('gi')
 
+    # Sequence
+    logger.info('Adding Sequence Index')
+    db.sequence.ensure_index([('genome', pymongo.ASCENDING), ('start', pymongo.ASCENDING)], unique=True)
+
     # GridFS
     #db.fs.chunks.ensure_Index([('files_id', pymongo.ASCENDING), ('n', pymongo.ASCENDING)], unique=True)
 
@@ -124,6 +128,9 @@ def setup_config(args):
     config.set('MongoDB', 'database', args.database or raw_input('Database [capsid]: ') or 'capsid')
     config.set('MongoDB', 'username', args.username or raw_input('Username [none]: '))
     config.set('MongoDB', 'password', args.password or getpass.getpass('Password [none]: '))
+    # Optional client settings, see database.OPTIONS
+    for option, default in sorted(OPTIONS.iteritems()):
+        config.set('MongoDB', option, default)
 
     # Writing our configuration file
     with open(os.path.expanduser('~/.capsid/capsid.cfg'), 'wb') as configfile:
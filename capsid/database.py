@@ -9,33 +9,210 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, ConfigParser
+import os, sys, ConfigParser
 
-from pymongo import Connection
+from pymongo import MongoClient, ReadPreference
+
+
+CONFIG_FILE = '~/.capsid/capsid.cfg'
+
+# Optional [MongoDB] settings and their defaults
+OPTIONS = {'pool_size': '100', 'write_concern': '1', 'read_preference': 'primary'}
+
+# Presets for --write-concern and the write_concern setting. fast-load also switches
+# bulk_insert to unordered bulk writes and makes verify_count check each stage.
+WRITE_CONCERNS = {
+    'unacknowledged': {'w': 0}
+    , 'acknowledged': {'w': 1}
+    , 'journaled': {'w': 1, 'j': True}
+    , 'majority': {'w': 'majority'}
+    , 'fast-load': {'w': 0}
+    }
+FAST_LOAD = 'fast-load'
+
+# The parsed config file, and the client of this process: (pid, settings, client)
+config_cache = None
+client_cache = None
+write_mode = None
+
+
+def read_config(path=CONFIG_FILE):
+    '''Returns the [MongoDB] settings from the config file, parsed again only when the file changes'''
+
+    global config_cache
+
+    path = os.path.expanduser(path)
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    if config_cache and config_cache[0] == (path, mtime):
+        return config_cache[1]
+
+    config = ConfigParser.ConfigParser(OPTIONS)
+    config.read(path)
+
+    settings = {
+        'host': config.get('MongoDB', 'host')
+        , 'port': int(config.get('MongoDB', 'port'))
+        , 'database': config.get('MongoDB', 'database')
+        , 'username': config.get('MongoDB', 'username')
+        , 'password': config.get('MongoDB', 'password')
+        , 'pool_size': int(config.get('MongoDB', 'pool_size'))
+        , 'write_concern': config.get('MongoDB', 'write_concern')
+        , 'read_preference': config.get('MongoDB', 'read_preference')
+        }
+    config_cache = ((path, mtime), settings)
+
+    return settings
+
+
+def write_concern(value):
+    '''Turns a write_concern setting (a preset, a number of servers or a tag set name) into client options'''
+
+    if value in WRITE_CONCERNS:
+        return dict(WRITE_CONCERNS[value])
+
+    return {'w': int(value) if value.isdigit() else value}
+
+
+def fast_load():
+    '''True when the fast-load write concern is in use'''
+
+    return write_mode == FAST_LOAD
+
+
+def read_preference(value):
+    '''Turns a read_preference setting such as secondaryPreferred into the pymongo constant'''
+
+    name = ''.join('_' + c if c.isupper() else c for c in value).upper()
+    return getattr(ReadPreference, name)
+
+
+def get_client(settings):
+    '''
+    Returns the MongoClient of this process for the settings. The client is created and
+    authenticated once, and created again in forked children since sockets are not fork safe.
+    '''
+
+    global client_cache
+
+    pid = os.getpid()
+    if client_cache and client_cache[0] == pid and client_cache[1] == settings:
+        return client_cache[2]
+
+    options = write_concern(settings['write_concern'])
+    options['read_preference'] = read_preference(settings['read_preference'])
+    # Unacknowledged writes and the counts that verify them must share a socket to stay in order
+    options['auto_start_request'] = settings['write_concern'] == FAST_LOAD
+    client = MongoClient(settings['host'], settings['port'], max_pool_size=settings['pool_size'], **options)
+    if settings['password']:
+        client[settings['database']].authenticate(settings['username'], settings['password'])
+
+    client_cache = (pid, settings, client)
+    return client
 
 
 def connect(args):
-    '''Connects to MongoDB using settings from the config file. Exits if no connection can be made.'''
+    '''
+    Connects to MongoDB using settings from the config file. Exits if no connection can be made.
+    With --profile-db the database times every round trip, see dbprofile.
+    '''
 
-    logger = args.logging.getLogger(__name__)
+    global write_mode
 
-    config = ConfigParser.ConfigParser()
-    config.read(os.path.expanduser('~/.capsid/capsid.cfg'))
+    logger = args.logging.getLogger(__name__)
 
     try:
-        address = config.get('MongoDB', 'host')
-        port = int(config.get('MongoDB', 'port'))
-        database = config.get('MongoDB', 'database')
-        username = config.get('MongoDB', 'username')
-        password = config.get('MongoDB', 'password')
+        settings = read_config()
+        read_preference(settings['read_preference'])
     except:
         logger.error('There is an error in the CaPSID configuration file. Please run `capsid configure` again.`')
         exit()
 
-    logger.debug('Connecting to {0}:{1} ({2})'.format(address, port, database))
-    connection = Connection(address, port)
-    authdb = connection[database]
-    if password:
-        authdb.authenticate(username, password)
+    # --write-concern takes precedence over the config file
+    if getattr(args, 'write_concern', None):
+        settings = dict(settings, write_concern=args.write_concern)
+    write_concern(settings['write_concern'])
+    write_mode = settings['write_concern']
+
+    if not client_cache or client_cache[0] != os.getpid():
+        logger.debug('Connecting to {0}:{1} ({2})'.format(settings['host'], settings['port'], settings['database']))
+
+    client = get_client(settings)
+    if getattr(args, 'profile_db', False):
+        import dbprofile
+        return dbprofile.profile(args, client, settings['database'])
+
+    return client[settings['database']]
+
+
+def insert_batch(collection, batch):
+    if fast_load():
+        bulk = collection.initialize_unordered_bulk_op()
+        for document in batch:
+            bulk.insert(document)
+        bulk.execute()
+    else:
+        collection.insert(batch)
+
+
+def bulk_insert(collection, documents, batch_size=10000):
+    '''
+    Inserts an iterable of documents in batches of batch_size, returns the number inserted.
+    With the fast-load write concern each batch is an unordered bulk write.
+    '''
+
+    batch, total = [], 0
+    for document in documents:
+        batch.append(document)
+        if len(batch) == batch_size:
+            insert_batch(collection, batch)
+            total += len(batch)
+            batch = []
+
+    if batch:
+        insert_batch(collection, batch)
+        total += len(batch)
+
+    return total
+
+
+def flush_writes(db):
+    '''Waits until the unacknowledged writes of this process have been applied, when other processes read them next'''
+
+    if fast_load():
+        db.command('getlasterror')
+
+
+def verify_count(logger, collection, query, expected):
+    '''
+    Unacknowledged fast-load writes fail silently, so stages end by counting the documents
+    that arrived. Exits if the count is not the expected one, does nothing in other modes.
+    '''
+
+    if not fast_load():
+        return
+
+    check_count(logger, collection, collection.find(query).count(), expected)
+
+
+def verify_count_in(logger, collection, field, values, query, expected, batch_size=10000):
+    '''
+    verify_count for the documents matching query whose field is one of values. The values
+    are counted batch_size at a time, as bulk_insert writes them, so no query comes near the
+    BSON document size limit however many documents a stage loads.
+    '''
+
+    if not fast_load():
+        return
+
+    found = 0
+    for i in xrange(0, len(values), batch_size):
+        found += collection.find(dict(query, **{field: {'$in': values[i:i + batch_size]}})).count()
+    check_count(logger, collection, found, expected)
+
+
+def check_count(logger, collection, found, expected):
+    if found != expected:
+        logger.error('Expected {0} documents in {1} but found {2}. Run again without --write-concern fast-load.'.format(expected, collection.name, found))
+        sys.exit(1)
 
-    return connection[database]
+    logger.debug('Verified {0} documents in {1}'.format(found, collection.name))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+'''
+MongoDB operation counts, latency histograms and slowest query shapes for --profile-db.
+
+pymongo 2 has no command monitoring, so connect hands out a Database whose collections,
+cursors and bulk writes time every round trip they make. Each process keeps its own
+profile, pool workers log theirs when they exit.
+'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from bisect import bisect_right
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import time
+
+from pymongo.bulk import BulkOperationBuilder
+from pymongo.collection import Collection
+from pymongo.cursor import Cursor
+from pymongo.database import Database
+
+
+# Upper bounds of the latency histogram buckets in milliseconds, the last bucket is open
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+SLOW_QUERIES = 10
+
+profiler = None
+logger = None
+
+
+def shape(query):
+    '''Replaces the values in a query with ?, keeping field names and operators'''
+
+    if isinstance(query, dict):
+        return dict((key, shape(value)) for key, value in query.iteritems())
+    if isinstance(query, (list, tuple)):
+        # $in lists have one shape whatever their length, $or and $and keep each clause
+        shapes = [shape(value) for value in query]
+        return shapes if any(isinstance(value, (dict, list)) for value in shapes) else ['?']
+
+    return '?'
+
+
+class Profiler(object):
+    '''Counts and times the MongoDB round trips of one process'''
+
+    def __init__(self, slow_queries=SLOW_QUERIES):
+        self.pid = os.getpid()
+        self.slow_queries = slow_queries
+        # (collection, operation): [count, seconds, max seconds, histogram]
+        self.operations = {}
+        # (collection, operation, query shape): [count, seconds, max seconds]
+        self.shapes = {}
+
+    def record(self, collection, operation, seconds, query=None):
+        key = (collection, operation)
+        if key not in self.operations:
+            self.operations[key] = [0, 0.0, 0.0, [0] * (len(BUCKETS) + 1)]
+        stats = self.operations[key]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+        stats[3][bisect_right(BUCKETS, seconds * 1000)] += 1
+
+        key += (json.dumps(shape(query or {}), sort_keys=True),)
+        if key not in self.shapes:
+            self.shapes[key] = [0, 0.0, 0.0]
+        stats = self.shapes[key]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+    def log(self, logger):
+        '''Logs the operation counts and histograms, then the query shapes that took the longest in total'''
+
+        if not self.operations:
+            return
+
+        total = sum(stats[0] for stats in self.operations.itervalues())
+        seconds = sum(stats[1] for stats in self.operations.itervalues())
+        logger.info('MongoDB profile of process {0}: {1} round trips, {2:.1f}s'.format(self.pid, total, seconds))
+
+        labels = ['<{0}'.format(bound) for bound in BUCKETS] + ['>{0}'.format(BUCKETS[-1])]
+        for (collection, operation), (n, seconds, slowest, histogram) in sorted(self.operations.iteritems(), key=lambda item: -item[1][1]):
+            buckets = ' '.join('{0}:{1}'.format(label, value) for label, value in zip(labels, histogram) if value)
+            logger.info('  {0}.{1}: {2} ops, {3:.2f}s, mean {4:.2f} ms, max {5:.1f} ms [ms {6}]'.format(
+                    collection, operation, n, seconds, 1000 * seconds / n, 1000 * slowest, buckets))
+
+        logger.info('Slowest query shapes by total time:')
+        slowest_shapes = sorted(self.shapes.iteritems(), key=lambda item: -item[1][1])[:self.slow_queries]
+        for (collection, operation, query), (n, seconds, slowest) in slowest_shapes:
+            logger.info('  {0}.{1} {2}: {3} x, {4:.2f}s, max {5:.1f} ms'.format(
+                    collection, operation, query, n, seconds, 1000 * slowest))
+
+
+def record(collection, operation, start, query=None):
+    if profiler is not None and profiler.pid == os.getpid():
+        profiler.record(collection, operation, time.time() - start, query)
+
+
+class ProfiledCursor(Cursor):
+    '''Times the query and each getmore, a cursor sends nothing until it is read'''
+
+    def __init__(self, collection, spec=None, *args, **kwargs):
+        Cursor.__init__(self, collection, spec, *args, **kwargs)
+        self.profile_query = spec
+        self.profile_operation = 'find_one' if kwargs.get('limit') == -1 else 'find'
+
+    def limit(self, limit):
+        # find_one reads its document through limit(-1)
+        if limit == -1:
+            self.profile_operation = 'find_one'
+        return Cursor.limit(self, limit)
+
+    def _refresh(self):
+        # A dead cursor or one with buffered documents does not go to the server
+        if not self.alive:
+            return Cursor._refresh(self)
+
+        operation = 'getmore' if self.cursor_id else self.profile_operation
+        start = time.time()
+        try:
+            return Cursor._refresh(self)
+        finally:
+            record(self.collection.name, operation, start, self.profile_query)
+
+
+class ProfiledBulk(BulkOperationBuilder):
+    def execute(self, write_concern=None):
+        start = time.time()
+        try:
+            return BulkOperationBuilder.execute(self, write_concern)
+        finally:
+            record(self.collection.name, 'bulk', start)
+
+
+class ProfiledCollection(Collection):
+    '''
+    Times inserts, updates, removes and bulk writes, and hands out profiled cursors. save
+    goes through insert or update, count, distinct and find_and_modify through Database.command.
+    '''
+
+    def __getattr__(self, name):
+        return ProfiledCollection(self.database, u'{0}.{1}'.format(self.name, name))
+
+    def find(self, *args, **kwargs):
+        # The options Collection.find adds before creating its cursor
+        for option in ('slave_okay', 'read_preference', 'tag_sets', 'secondary_acceptable_latency_ms'):
+            if option not in kwargs:
+                kwargs[option] = getattr(self, option)
+        return ProfiledCursor(self, *args, **kwargs)
+
+    def insert(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return Collection.insert(self, *args, **kwargs)
+        finally:
+            record(self.name, 'insert', start)
+
+    def update(self, spec, *args, **kwargs):
+        start = time.time()
+        try:
+            return Collection.update(self, spec, *args, **kwargs)
+        finally:
+            record(self.name, 'update', start, spec)
+
+    def remove(self, spec_or_id=None, *args, **kwargs):
+        start = time.time()
+        try:
+            return Collection.remove(self, spec_or_id, *args, **kwargs)
+        finally:
+            record(self.name, 'remove', start, spec_or_id if spec_or_id is None or isinstance(spec_or_id, dict) else {'_id': spec_or_id})
+
+    def aggregate(self, pipeline, **kwargs):
+        start = time.time()
+        try:
+            return Collection.aggregate(self, pipeline, **kwargs)
+        finally:
+            record(self.name, 'aggregate', start, pipeline[0] if pipeline else None)
+
+    def initialize_unordered_bulk_op(self):
+        return ProfiledBulk(self, ordered=False)
+
+    def initialize_ordered_bulk_op(self):
+        return ProfiledBulk(self, ordered=True)
+
+
+class ProfiledDatabase(Database):
+    '''A Database with profiled collections, still a Database for GridFS and isinstance checks'''
+
+    def __getattr__(self, name):
+        return ProfiledCollection(self, name)
+
+    def __getitem__(self, name):
+        return self.__getattr__(name)
+
+    def command(self, command, value=1, *args, **kwargs):
+        # Commands on a collection such as count and distinct name it as their value
+        name = command if isinstance(command, basestring) else next(iter(command), '$cmd')
+        target = value if isinstance(command, basestring) else command.get(name)
+        collection = target if isinstance(target, basestring) else '$cmd'
+
+        start = time.time()
+        try:
+            return Database.command(self, command, value, *args, **kwargs)
+        finally:
+            record(collection, name, start, kwargs.get('query'))
+
+
+def report():
+    '''Logs the profile of this process, when it has one'''
+
+    if profiler is not None and profiler.pid == os.getpid():
+        profiler.log(logger)
+
+
+def profile(args, client, name):
+    '''
+    Returns the profiled database name of client. The first call in a process starts its
+    profile, in a multiprocessing worker the profile is logged when the worker exits.
+    '''
+
+    global profiler, logger
+
+    logger = args.logging.getLogger(__name__)
+
+    if profiler is None or profiler.pid != os.getpid():
+        profiler = Profiler(getattr(args, 'slow_queries', SLOW_QUERIES))
+        if multiprocessing.current_process().name != 'MainProcess':
+            multiprocessing.util.Finalize(None, report, exitpriority=10)
+
+    return ProfiledDatabase(client, name)
+
+
+if __name__ == '__main__':
+    print 'This program should be run as part of the capsid package:\n\t$ capsid --profile-db <command> -h\n\tor\n\t$ /path/to/capsid/bin/capsid --profile-db <command> -h'
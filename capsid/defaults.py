@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+'''
+Defaults shared by the subcommand modules and the argument parser in bin/capsid. This module
+imports nothing, so the parser can use it without loading the modules it describes.
+'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# --profile modes, see profiling
+PROFILE_MODES = ['cprofile', 'sample']
+
+# Sequence store encodings and bases per chunk document, a multiple of the 80 column FASTA
+# line width, see seqstore
+SEQUENCE_ENCODINGS = ['raw', 'zlib', '2bit', '4bit']
+SEQUENCE_CHUNK_SIZE = 80 * 13107
+
+# Reads held in memory before sam2bam writes a sorted chunk to a temporary BAM
+SORT_CHUNK_SIZE = 500000
+
+# Temporary chunk files sam2bam merges at a time, well below common open file limits
+MERGE_BATCH_SIZE = 64
@@ -10,29 +10,123 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import deque, namedtuple
+from multiprocessing.pool import ThreadPool
+import hashlib
+import os
 import re
 
-import gridfs
-
 from database import *
+from seqstore import SequenceStore, wrap
+from bgzf import BgzfWriter
+from instrument import stage
+
+Entry = namedtuple('Entry', ['gi', 'accession', 'version', 'length', 'checksum'])
+
+store = None
+
+# Line width of the FASTA output, also written to the .fai index
+WIDTH = 80
+
+
+def prefetch(pool, func, items, window):
+    '''Like pool.imap but never has more than window results in flight, so memory stays bounded'''
+
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+def fetch_sequence(genome):
+    '''Returns the genome with its sequence as one block of wrapped lines, and the sequence checksum'''
+
+    md5 = hashlib.md5()
+    chunks = list(store.chunks(genome['gi']))
+    [md5.update(chunk) for chunk in chunks]
+
+    return genome, ''.join(wrap(chunks, WIDTH)), md5.hexdigest()
+
+
+def read_manifest(path):
+    '''Returns the manifest entries of a previous export keyed by GI'''
+
+    with open(path) as fh:
+        entries = [Entry._make(line.rstrip('\n').split('\t')) for line in fh if not line.startswith('#')]
+
+    return dict((int(entry.gi), entry) for entry in entries)
+
+
+def write_manifest(path, entries):
+    '''Writes the gi, accession, version, length and sequence checksum of every exported genome'''
+
+    with open(path, 'w') as fh:
+        fh.write('#{0}\n'.format('\t'.join(Entry._fields)))
+        [fh.write('{0}\n'.format('\t'.join(str(value) for value in entry)))
+         for entry in sorted(entries, key=lambda entry: entry.gi)]
 
-fs = None
 
-def fasta_output(genome, out):
+def manifest_entry(genome, checksum):
+    return Entry(genome['gi'], genome['accession'], genome['version'], genome.get('length', 0), checksum)
+
+
+def unchanged(entry, previous):
+    '''True if the genome is in the previous manifest with the same version and checksum'''
+
+    old = previous.get(entry.gi)
+    return old is not None and (old.version, old.checksum) == (str(entry.version), entry.checksum)
+
+
+def fasta_output(genome, sequence, out, index=None):
     '''Output Genome in Fasta format'''
 
-    out.write('>gi|{gi}|ref|{accession}.{version}| {name}\n'.format(**genome))
-    [out.write('{0}\n'.format(line)) for line in fs.get_last_version(str(genome['gi']))] 
+    header = '>gi|{gi}|ref|{accession}.{version}| {name}\n'.format(**genome)
+    out.write(header)
+
+    if index is not None:
+        bases = len(sequence) - sequence.count('\n')
+        index.append((header[1:].split()[0], bases, out.tell()))
+
+    out.write(sequence)
+
+
+def delta_paths(output):
+    '''Paths of the delta fasta and the removed genomes list of an incremental export, next to output'''
+
+    base, gz = (output[:-3], '.gz') if output.endswith('.gz') else (output, '')
+    root, ext = os.path.splitext(base)
+
+    return root + '.delta' + ext + gz, root + '.removed'
+
+
+def write_removed(path, entries):
+    '''Writes the gi and accession of the genomes removed since the previous manifest'''
+
+    with open(path, 'w') as fh:
+        fh.write('#gi\taccession\n')
+        [fh.write('{0}\t{1}\n'.format(entry.gi, entry.accession)) for entry in sorted(entries, key=lambda entry: int(entry.gi))]
+
+
+def write_fai(path, index):
+    '''Writes a samtools .fai index for the records written'''
+
+    with open(path, 'w') as fai:
+        [fai.write('{0}\t{1}\t{2}\t{3}\t{4}\n'.format(name, bases, offset, WIDTH, WIDTH + 1))
+         for name, bases, offset in index]
 
 
 def main(args):
     '''Fasta Output of Genomes in the Database'''
 
-    global fs
+    global store
 
     logger = args.logging.getLogger(__name__)
     db = connect(args)
-    fs = gridfs.GridFS(db)
+    store = SequenceStore(db)
     
     # By default the query will not include Human
     query = {"organism": {'$ne': "Homo sapiens"}}
@@ -45,11 +139,75 @@ def main(args):
     genomes = db.genome.find(query)
     logger.info('Found {0} genomes'.format(genomes.count()))
 
-    logger.debug('Writing Fasta output to {0}...'.format(args.output))
-    with open(args.output, 'w') as out:
-        [fasta_output(genome, out) for genome in genomes]
-
-    logger.info('{0} created.'.format(args.output))
+    threads = int(args.threads)
+    output = args.output
+    if args.bgzip and not output.endswith('.gz'):
+        output += '.gz'
+
+    previous = read_manifest(args.since_manifest) if args.since_manifest else {}
+    manifest = []
+
+    def to_fetch(genomes):
+        '''Genomes whose stored checksum matches the previous manifest are not fetched at all'''
+        for genome in genomes:
+            if 'checksum' in genome and unchanged(manifest_entry(genome, genome['checksum']), previous):
+                manifest.append(manifest_entry(genome, genome['checksum']))
+            else:
+                yield genome
+
+    # An incremental export leaves the full export alone and writes a delta next to it
+    target, removed_path = delta_paths(output) if args.since_manifest else (output, None)
+    partial = target + '.tmp'
+
+    logger.debug('Writing Fasta output to {0}...'.format(target))
+    out = BgzfWriter(partial, threads) if args.bgzip else open(partial, 'wb', 1 << 20)
+    index = []
+
+    # Sequences are fetched by a pool of threads a few genomes ahead of the writer
+    pool = ThreadPool(threads)
+    try:
+        with out, stage('write fasta', logger, 'genomes') as s:
+            for genome, sequence, checksum in s.meter(prefetch(pool, fetch_sequence, to_fetch(genomes), threads * 2)):
+                entry = manifest_entry(genome, checksum)
+                manifest.append(entry)
+                if not unchanged(entry, previous):
+                    fasta_output(genome, sequence, out, index)
+    except:
+        os.remove(partial)
+        raise
+    finally:
+        pool.close()
+
+    if args.since_manifest:
+        removed = set(previous) - set(entry.gi for entry in manifest)
+        logger.info('{0} new or changed genomes, {1} removed since {2}'.format(len(index), len(removed), args.since_manifest))
+
+        if not index and not removed:
+            # A delta left by an earlier run would say something changed
+            os.remove(partial)
+            [os.remove(path) for path in [target + ext for ext in ('', '.fai', '.gzi', '.manifest')] + [removed_path]
+             if os.path.exists(path)]
+            logger.info('No genomes changed since {0}, {1} left as it is.'.format(args.since_manifest, output))
+            return
+
+        # Removed genomes have no record in the delta, the index still has to be rebuilt without them
+        if removed:
+            write_removed(removed_path, [previous[gi] for gi in removed])
+            logger.info('{0} genomes removed since {1}, listed in {2}'.format(len(removed), args.since_manifest, removed_path))
+        elif os.path.exists(removed_path):
+            os.remove(removed_path)
+        if not index:
+            logger.warning('Only removals since {0}, {1} has no records but the index must be rebuilt.'.format(args.since_manifest, target))
+
+    os.rename(partial, target)
+    write_manifest(target + '.manifest', manifest)
+
+    if args.bgzip:
+        logger.debug('Writing {0}.fai and {0}.gzi...'.format(target))
+        write_fai(target + '.fai', index)
+        out.write_gzi(target + '.gzi')
+
+    logger.info('{0} created.'.format(target))
 
 
 if __name__ == '__main__':
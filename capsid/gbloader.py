@@ -11,46 +11,126 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from __future__ import division
 from itertools import count
 from collections import namedtuple
+from cStringIO import StringIO
+import hashlib
+import io
 import re
+import sys
+import zlib
 
 from Bio import SeqIO
-import gridfs
+import numpy
 
 from database import *
+from seqstore import SequenceStore
+from instrument import stage
 
 
 Qualifiers = namedtuple('Qualifiers', ['name', 'geneId', 'locusTag'])
-Counter = namedtuple('Counter', ['records', 'genomes', 'pending', 'features', 'sequences'])
+Counter = namedtuple('Counter', ['records', 'skipped', 'genomes', 'pending', 'features', 'sequences'])
+Composition = namedtuple('Composition', ['length', 'acgt', 'gc', 'n'])
 
 db = None
-fs = None
+store = None
+encoding = None
 logger = None
-counter = Counter(count(), count(), count(), count(), count())
+counter = Counter(count(), count(), count(), count(), count(), count())
+gi_regex = re.compile('GI:(\d+)')
 
+ACGT = [ord(base) for base in 'ACGTacgt']
+GC = [ord(base) for base in 'GCgc']
+N = [ord(base) for base in 'Nn']
 
-def valid_seq(record):
-    '''Filters out unknown sequences that are all 'N' so they are not saved'''
+GZIP_MAGIC = '\x1f\x8b'
+BLOCK_SIZE = 1 << 20
+
+
+class GzipStream(io.RawIOBase):
+    '''
+    Streaming gzip decompressor that only ever reads forward, so it also works on pipes.
+    Concatenated members (as written by bgzip) are decompressed one after the other.
+    '''
 
-    # This is strangely much faster than regexes. Double the speed, or even a little more
-    string = record.seq.tostring()
-    if 'A' in string or 'C' in string or 'G' in string or 'T' in string:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.pending = ''
+        self.offset = 0
+
+    def readable(self):
         return True
-    else:
-        return False
+
+    def readinto(self, b):
+        while self.offset == len(self.pending):
+            if self.decompressor.unused_data:
+                data = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = self.fileobj.read(BLOCK_SIZE)
+                if not data:
+                    self.pending, self.offset = self.decompressor.flush(), 0
+                    if not self.pending:
+                        return 0
+                    break
+            self.pending, self.offset = self.decompressor.decompress(data), 0
+
+        n = min(len(b), len(self.pending) - self.offset)
+        b[:n] = self.pending[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self):
+        self.fileobj.close()
+        super(GzipStream, self).close()
+
+
+def open_gb_file(f):
+    '''Opens a GenBank file for reading, '-' reads from stdin and gzip input is decompressed on the fly'''
+
+    raw = io.open(sys.stdin.fileno(), 'rb', BLOCK_SIZE, closefd=False) if f == '-' else io.open(f, 'rb', BLOCK_SIZE)
+
+    if raw.peek(2)[:2] == GZIP_MAGIC:
+        logger.debug('{0} is gzip compressed'.format(f))
+        return io.BufferedReader(GzipStream(raw), BLOCK_SIZE)
+
+    return raw
+
+
+def composition(seq):
+    '''Counts the bases of a sequence in a single pass over a view of its bytes, the string is not copied'''
+
+    if not seq:
+        return Composition(0, 0, 0, 0)
+
+    counts = numpy.bincount(numpy.frombuffer(seq, numpy.uint8), minlength=256)
+
+    return Composition(len(seq), int(counts[ACGT].sum()), int(counts[GC].sum()), int(counts[N].sum()))
+
+
+def valid_seq(bases):
+    '''Filters out unknown sequences that are all 'N' so they are not saved'''
+
+    return bases.acgt > 0
 
 
 def extract_sequence(record, genome, delete=False):
-    '''Returns a dictionary of the genome sequence'''
+    '''Saves the genome sequence and records its GC content, N fraction and checksum on the genome'''
     global counter
 
-    if valid_seq(record):
+    seq = str(record.seq)
+    bases = composition(seq)
+
+    if valid_seq(bases):
         counter.sequences.next()
         if delete:
-            seq_id = fs.get_last_version(str(genome['gi']))._id
-            fs.delete(seq_id)
-        fs.put(record.seq.tostring(), filename=str(genome['gi']), chunkSize=80)
+            store.delete(genome['gi'])
+        store.put(genome['gi'], seq, encoding)
+        genome['gc'] = bases.gc / bases.acgt
+        genome['nFraction'] = bases.n / bases.length
+        genome['checksum'] = hashlib.md5(seq).hexdigest()
 
 
 def get_qualifiers(qualifiers):
@@ -73,7 +153,7 @@ def get_qualifiers(qualifiers):
 def build_subfeatures(feature, genome):
     '''Needed for features with locations that are 'join' or 'order'. Recreates the parent features multiple times using the subfeatures' location.'''
 
-    [build_feature(feature, genome, sf.location) for sf in feature.sub_features]
+    return [build_feature(feature, genome, sf.location) for sf in feature.sub_features]
 
 
 def build_feature(feature, genome, sf_location = None):
@@ -84,7 +164,7 @@ def build_feature(feature, genome, sf_location = None):
     qualifiers = get_qualifiers(feature.qualifiers)
     feature.location = sf_location or feature.location
 
-    db.feature.insert({
+    return {
         "name": qualifiers.name
         , "uid": str(qualifiers.name) + '-' + str(genome['gi']) + '-' + str(qualifiers.geneId) + '-' + str(feature.location.nofuzzy_start + 1) + '-' + str(feature.location.nofuzzy_end)
         , "genome": genome['gi']
@@ -95,7 +175,7 @@ def build_feature(feature, genome, sf_location = None):
         , "operator": feature.location_operator
         , "strand": feature.strand
         , "type": feature.type
-        })
+        }
 
 
 def extract_feature(feature, genome):
@@ -103,7 +183,7 @@ def extract_feature(feature, genome):
 
     has_subs = feature.location_operator in ['join', 'order']
 
-    build_subfeatures(feature, genome) if has_subs else build_feature(feature, genome)
+    return build_subfeatures(feature, genome) if has_subs else [build_feature(feature, genome)]
 
 
 def extract_features(record, genome, delete=False):
@@ -111,7 +191,8 @@ def extract_features(record, genome, delete=False):
 
     if delete: db.feature.remove({'genome': genome['gi']})
 
-    [extract_feature(f, genome) for f in record.features[1:] if f.type in ['gene', 'CDS']]
+    features = [extract_feature(f, genome) for f in record.features[1:] if f.type in ['gene', 'CDS']]
+    bulk_insert(db.feature, (feature for group in features for feature in group))
 
 
 def extract_genome(record, delete):
@@ -175,6 +256,8 @@ def parse_record(record, saved_genomes, pending_genomes, repair):
 
     db.genome.save(genome)
 
+    return genome['gi']
+
 
 def get_pending_genomes():
     '''Returns a set of genomes with pending transactions'''
@@ -188,14 +271,42 @@ def get_saved_genomes():
     return set(genome['gi'] for genome in db.genome.find({'pending': {'$exists': False}}).hint([('_id', 1)]))
 
 
+def prefilter_records(fh, saved_genomes):
+    '''
+    Splits a GenBank stream into the text of each record, looking only at the VERSION line.
+    Records whose GI is already saved are skipped line by line and never reach SeqIO.
+    '''
+    global counter
+
+    lines, skipping = [], False
+    for line in fh:
+        if skipping:
+            skipping = not line.startswith('//')
+            continue
+
+        lines.append(line)
+        if line.startswith('VERSION'):
+            match = gi_regex.search(line)
+            if match and int(match.group(1)) in saved_genomes:
+                counter.records.next()
+                counter.skipped.next()
+                lines, skipping = [], True
+        elif line.startswith('//'):
+            yield ''.join(lines)
+            lines = []
+
+
 def parse_gb_file(f, repair):
     '''Use SeqIO to extract genome data from GenBank files'''
-    logger.info('Scanning GenBank File {0}'.format(f))
-
-    with open(f, 'rU') as fh:
-        pending_genomes = get_pending_genomes() if not repair else []
-        saved_genomes = get_saved_genomes() if not repair else []
-        [parse_record(r, saved_genomes, pending_genomes, repair) for r in SeqIO.parse(fh, 'gb')]
+    logger.info('Scanning GenBank File {0}'.format('<stdin>' if f == '-' else f))
+
+    with open_gb_file(f) as fh:
+        pending_genomes = get_pending_genomes() if not repair else set()
+        saved_genomes = get_saved_genomes() if not repair else set()
+        records = (SeqIO.read(StringIO(text), 'gb') for text in prefilter_records(fh, saved_genomes))
+        with stage('GenBank parse', logger, 'records') as s:
+            loaded = filter(None, [parse_record(r, saved_genomes, pending_genomes, repair) for r in s.meter(records)])
+        verify_count_in(logger, db.genome, 'gi', loaded, {'pending': {'$exists': False}}, len(loaded))
         summary()
 
 
@@ -206,6 +317,7 @@ def summary():
     # Counter starts at 0, so >it = count(); >print it.next(); >0
     # Using counter.*.next here sets it to the correct value for printing.
     records = counter.records.next()
+    skipped = counter.skipped.next()
     genomes = counter.genomes.next()
     pending = counter.pending.next()
     features = counter.features.next()
@@ -213,6 +325,8 @@ def summary():
 
     if records:
         logger.info("{0} Genomes found, {1} new Genomes added.".format(records, genomes))
+        if skipped:
+            logger.info('{0} Genomes already loaded were skipped before parsing'.format(skipped))
         if pending:
             logger.info('{0} Genome found with pending transactions'.format(pending))
         if features:
@@ -223,20 +337,22 @@ def summary():
         logger.info('No Genomes found, make sure this is a GenBank file.')
 
     # Reset the counter for the next file
-    counter = Counter(count(), count(), count(), count(), count())
+    counter = Counter(count(), count(), count(), count(), count(), count())
 
 
 def main(args):
     '''
     Reads through GenBank files and loads data into MongoDB in the genome, feature and sequence collections.
-    python gloader.py g1.gbff gb2.gbff',
+    python gloader.py g1.gbff gb2.gbff.gz',
+    curl -s ftp://.../viral.1.genomic.gbff.gz | python gloader.py -
     '''
 
-    global db, fs, logger
+    global db, store, encoding, logger
 
     logger = args.logging.getLogger(__name__)
     db = connect(args)
-    fs = gridfs.GridFS(db)
+    store = SequenceStore(db)
+    encoding = args.encoding
     
     [parse_gb_file(f, args.repair) for f in args.files]
 
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+'''
+Hit sidecars: the fields statistics reads from the mapped documents of an alignment, as
+numpy arrays in an .npz file written by subtraction --sidecar.
+
+A sidecar holds the genome, refStart, refEnd, mapsGene and isRef of every mapped document
+the subtraction run inserted, sorted by genome and position, with the genomes and the
+offsets of their hits, and the ids of the alignment, sample and project.
+'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from array import array
+import errno
+import glob
+import os
+
+from bson.objectid import ObjectId
+import numpy
+
+
+EXTENSION = '.hits.npz'
+VERSION = 1
+
+
+class Hits(object):
+    '''Hit arrays sorted by genome, start and end, and grouped by genome'''
+
+    def __init__(self, genome, start, end, maps_gene, is_ref):
+        order = numpy.lexsort((end, start, genome))
+        self.genome = genome[order]
+        self.start = start[order]
+        self.end = end[order]
+        self.maps_gene = maps_gene[order]
+        self.is_ref = is_ref[order]
+
+        self.genomes, first = numpy.unique(self.genome, return_index=True)
+        self.offsets = numpy.append(first, len(self.genome))
+
+    def __len__(self):
+        return len(self.genome)
+
+    def by_genome(self):
+        '''Yields each genome with its Hits'''
+
+        for i, gi in enumerate(self.genomes):
+            hits = slice(self.offsets[i], self.offsets[i + 1])
+            yield int(gi), GenomeHits(self.start[hits], self.end[hits], self.maps_gene[hits], self.is_ref[hits])
+
+    @classmethod
+    def concat(cls, hits):
+        '''Combines the hits of several alignments, as those of a sample or a project'''
+
+        hits = list(hits)
+        return cls(*[numpy.concatenate([getattr(h, field) for h in hits]) if hits else numpy.empty(0, numpy.int64)
+                     for field in ('genome', 'start', 'end', 'maps_gene', 'is_ref')])
+
+
+class GenomeHits(object):
+    '''The hits on one genome'''
+
+    def __init__(self, start, end, maps_gene, is_ref):
+        self.start, self.end, self.maps_gene, self.is_ref = start, end, maps_gene, is_ref
+
+    def __len__(self):
+        return len(self.start)
+
+    def select(self, mask):
+        return GenomeHits(self.start[mask], self.end[mask], self.maps_gene[mask], self.is_ref[mask])
+
+
+class HitCollector(object):
+    '''Collects the hits of the mapped documents subtraction inserts, a few bytes each'''
+
+    def __init__(self):
+        self.genome = array('l')
+        self.start = array('l')
+        self.end = array('l')
+        self.maps_gene = array('b')
+        self.is_ref = array('b')
+        self.readids = []
+
+    def add(self, mapped):
+        self.genome.append(mapped['genome'])
+        self.start.append(mapped['refStart'])
+        self.end.append(mapped['refEnd'])
+        self.maps_gene.append('mapsGene' in mapped)
+        self.is_ref.append(mapped.get('isRef') == 1)
+        self.readids.append(mapped['readId'])
+
+    def write(self, directory, meta, ref_readids):
+        '''
+        Writes the sidecar of the alignment, returns its path. Hits of reads that also map
+        to the reference are marked isRef, as subtraction does in the mapped collection.
+        '''
+
+        is_ref = numpy.array(self.is_ref, bool)
+        if ref_readids:
+            is_ref |= numpy.fromiter((readid in ref_readids for readid in self.readids), bool, len(self.readids))
+
+        hits = Hits(numpy.array(self.genome, numpy.int64), numpy.array(self.start, numpy.int64),
+                    numpy.array(self.end, numpy.int64), numpy.array(self.maps_gene, bool), is_ref)
+
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        path = os.path.join(directory, meta.alignment['name'] + EXTENSION)
+        numpy.savez_compressed(path, version=VERSION, genome=hits.genome, refStart=hits.start.astype(numpy.int32),
+                               refEnd=hits.end.astype(numpy.int32), mapsGene=hits.maps_gene, isRef=hits.is_ref,
+                               genomes=hits.genomes, offsets=hits.offsets,
+                               alignmentId=str(meta.alignment['_id']), sampleId=str(meta.sample['_id']),
+                               projectId=str(meta.sample['projectId']))
+
+        return path
+
+
+def load(path):
+    '''Returns the owner ids and the Hits of a sidecar'''
+
+    data = numpy.load(path)
+    if int(data['version']) != VERSION:
+        raise ValueError('{0} is a version {1} sidecar, expected version {2}'.format(path, int(data['version']), VERSION))
+
+    owner = dict((field, ObjectId(str(data[field]))) for field in ('alignmentId', 'sampleId', 'projectId'))
+    hits = Hits(data['genome'], data['refStart'].astype(numpy.int64), data['refEnd'].astype(numpy.int64),
+                data['mapsGene'], data['isRef'])
+
+    return owner, hits
+
+
+def load_directory(directory):
+    '''Returns the owner ids and the Hits of every sidecar in directory, by alignment id'''
+
+    sidecars = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*' + EXTENSION))):
+        owner, hits = load(path)
+        sidecars[owner['alignmentId']] = (owner, hits)
+
+    return sidecars
+
+
+if __name__ == '__main__':
+    print 'This program should be run as part of the capsid package:\n\t$ capsid statistics --from-sidecar DIR -h\n\tor\n\t$ /path/to/capsid/bin/capsid statistics --from-sidecar DIR -h'
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+'''Stage timers, rate meters and peak memory sampling, written as a JSON report for each run'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import resource
+import socket
+import sys
+import time
+
+
+# One JSON report per line, appended after every run
+REPORT_FILE = '~/.capsid/capsid.report.json'
+
+run = None
+stages = []
+
+
+def peak_rss():
+    '''Peak resident memory of this process in MB'''
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X and in kilobytes on Linux
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+class Stage(object):
+    '''
+    Times a named stage and records how many items it handled and the peak memory when it ended.
+    Used as a context manager, items are counted with add() or by iterating through meter().
+    '''
+
+    def __init__(self, name, logger=None, unit='items'):
+        self.name = name
+        self.logger = logger
+        self.unit = unit
+        self.count = 0
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.time() - self.start
+        record = {
+            'name': self.name
+            , 'seconds': round(seconds, 3)
+            , 'count': self.count
+            , 'unit': self.unit
+            , 'rate': round(self.count / seconds, 1) if seconds else None
+            , 'peakRssMb': round(peak_rss(), 1)
+            , 'failed': exc_type is not None
+            }
+        stages.append(record)
+
+        if self.logger:
+            rate = ' ({0:.0f} {1}/s)'.format(record['rate'], self.unit) if record['rate'] else ''
+            items = ', {0} {1}{2}'.format(self.count, self.unit, rate) if self.count else ''
+            self.logger.info('{0}: {1:.1f}s{2}, peak RSS {3:.0f} MB'.format(self.name, seconds, items, record['peakRssMb']))
+
+    def add(self, n=1):
+        self.count += n
+
+    def meter(self, iterable):
+        '''Yields the items of iterable, counting them'''
+
+        for item in iterable:
+            self.count += 1
+            yield item
+
+
+def stage(name, logger=None, unit='items'):
+    '''Returns a Stage context manager, see Stage'''
+
+    return Stage(name, logger, unit)
+
+
+def start(args, version=None, argv=None):
+    '''Starts the report for a run of a subcommand'''
+
+    global run, stages
+
+    stages = []
+    run = {
+        'command': args.func.__name__.rstrip('_')
+        , 'argv': list(sys.argv if argv is None else argv)
+        , 'version': version
+        , 'host': socket.gethostname()
+        , 'pid': os.getpid()
+        , 'started': time.strftime('%Y-%m-%dT%H:%M:%S')
+        , 'start': time.time()
+        }
+
+
+def report(status):
+    '''Returns the report of the current run as a dict'''
+
+    result = dict(run)
+    result['seconds'] = round(time.time() - result.pop('start'), 3)
+    result['status'] = status
+    result['peakRssMb'] = round(peak_rss(), 1)
+    result['stages'] = stages
+
+    return result
+
+
+def finish(status='ok', path=REPORT_FILE):
+    '''Appends the report of the run to the report file'''
+
+    if run is None:
+        return
+
+    with open(os.path.expanduser(path), 'a') as fh:
+        fh.write(json.dumps(report(status)) + '\n')
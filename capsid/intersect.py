@@ -12,6 +12,8 @@ import time
 import os
 import subprocess
 
+from instrument import stage
+
 logger = None
 temp = None
 
@@ -75,8 +77,11 @@ def main(args):
     logger = args.logging.getLogger(__name__)
     temp = args.temp
 
-    collapse_file(args.files[0], 'saved.fq')
-    map(intersect_files, args.files[1:])
+    with stage('collapse', logger, 'files') as s:
+        collapse_file(args.files[0], 'saved.fq')
+        s.add()
+    with stage('intersect', logger, 'files') as s:
+        map(intersect_files, s.meter(args.files[1:]))
 
     p = subprocess.Popen(["wc", "-l", "saved.fq"], stdout=subprocess.PIPE)
     reads = p.communicate()[0].partition(' ')[0]
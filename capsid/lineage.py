@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+'''Compact taxonomy snapshot file and lineage queries against it, without MongoDB round trips'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import struct
+
+import numpy
+
+
+# File layout: MAGIC, uint32 header length, JSON header, then the arrays at the
+# offsets listed in the header. Every array is indexed by taxID.
+MAGIC = 'CAPSIDTX'
+VERSION = 1
+ARRAYS = [('parent', '<i4'), ('left', '<i4'), ('right', '<i4'), ('rank', 'u1')]
+
+
+def write_snapshot(path, tree):
+    '''
+    Writes the parent, rank and nested set arrays of a taxonomy.Tree to path.
+    Taxa that are not in the tree have a parent of -1, the virtual root 0 holds the whole tree.
+    '''
+
+    size = max(tree.parents) + 1
+    ranks = sorted(set(tree.ranks.itervalues()))
+    rank_codes = dict((rank, code) for code, rank in enumerate(ranks))
+
+    arrays = dict((name, numpy.zeros(size, dtype)) for name, dtype in ARRAYS)
+    arrays['parent'].fill(-1)
+
+    for taxid, parent in tree.parents.iteritems():
+        arrays['parent'][taxid] = parent
+        arrays['rank'][taxid] = rank_codes[tree.ranks[taxid]]
+    for taxid, left in tree.left.iteritems():
+        arrays['left'][taxid] = left
+        arrays['right'][taxid] = tree.right[taxid]
+
+    header = {'version': VERSION, 'size': size, 'ranks': ranks, 'arrays': []}
+    offset = 0
+    for name, dtype in ARRAYS:
+        header['arrays'].append([name, dtype, offset])
+        offset += arrays[name].nbytes
+
+    # Pad the header so the arrays start 8 byte aligned
+    text = json.dumps(header)
+    text += ' ' * (-(len(MAGIC) + 4 + len(text)) % 8)
+
+    temp = path + '.tmp'
+    with open(temp, 'wb') as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack('<I', len(text)))
+        fh.write(text)
+        for name, dtype in ARRAYS:
+            fh.write(arrays[name].tostring())
+    os.rename(temp, path)
+
+
+class Lineage(object):
+    '''
+    Memory maps a taxonomy snapshot. ancestors is O(depth), is_descendant is O(1)
+    using the nested set values and lca is O(depth) per taxon.
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{0} is not a CaPSID taxonomy snapshot'.format(path))
+            length, = struct.unpack('<I', fh.read(4))
+            header = json.loads(fh.read(length))
+
+        if header['version'] != VERSION:
+            raise ValueError('Unsupported taxonomy snapshot version {0}'.format(header['version']))
+
+        start = len(MAGIC) + 4 + length
+        self.size = header['size']
+        self.ranks = header['ranks']
+        for name, dtype, offset in header['arrays']:
+            setattr(self, '_' + name, numpy.memmap(path, dtype, 'r', start + offset, (self.size,)))
+
+    def __contains__(self, taxid):
+        return 0 <= taxid < self.size and self._parent[taxid] != -1
+
+    def check(self, taxid):
+        if taxid not in self:
+            raise KeyError(taxid)
+
+    def parent(self, taxid):
+        '''Returns the parent taxID, 0 for the top level taxa'''
+
+        self.check(taxid)
+        return int(self._parent[taxid])
+
+    def rank(self, taxid):
+        '''Returns the rank name of a taxon'''
+
+        self.check(taxid)
+        return self.ranks[self._rank[taxid]]
+
+    def left(self, taxid):
+        self.check(taxid)
+        return int(self._left[taxid])
+
+    def right(self, taxid):
+        self.check(taxid)
+        return int(self._right[taxid])
+
+    def ancestors(self, taxid):
+        '''Returns the taxIDs from the parent of taxid up to the top of the tree'''
+
+        lineage = []
+        node = self.parent(taxid)
+        while node > 0:
+            lineage.append(node)
+            node = int(self._parent[node])
+
+        return lineage
+
+    def is_descendant(self, a, b):
+        '''True if taxon a is strictly below taxon b'''
+
+        self.check(a)
+        if b != 0:
+            self.check(b)
+
+        return bool(self._left[b] < self._left[a] and self._right[a] < self._right[b])
+
+    def lca(self, taxids):
+        '''Returns the lowest common ancestor of the taxa, 0 if they only share the virtual root'''
+
+        taxids = list(taxids)
+        node = taxids[0]
+        self.check(node)
+
+        for taxid in taxids[1:]:
+            self.check(taxid)
+            while node and node != taxid and not self.is_descendant(taxid, node):
+                node = int(self._parent[node])
+
+        return node
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+'''
+Compact schema of the mapped read documents, written by subtraction --compact.
+
+Schema 2 documents keep every field statistics queries and indexes as it is, and store the
+sequence 2-bit packed, the qualities as phred scores and the CIGAR as BAM packed integers,
+each as BSON binary. The owner fields (projectLabel, sample, alignment, platform and
+sequencingType) are left out, decode joins them back from the alignment.
+
+Readers of the mapped collection have to decode schema 2 documents with MappedReader,
+capsid mapped exports the reads of an alignment that way. The web UI reads the fields
+directly and cannot show schema 2 documents yet.
+'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from itertools import imap
+import struct
+import sys
+
+from bson.binary import Binary
+
+from database import *
+from instrument import stage
+from seqstore import pack, unpack
+
+
+SCHEMA = 2
+
+# Fields of schema 1 documents and the alignment fields they copy
+OWNER_FIELDS = {'projectLabel': 'projectLabel', 'sample': 'sample', 'alignment': 'name',
+                'platform': 'platform', 'sequencingType': 'type'}
+
+# Sequences are binary of a user defined subtype naming their encoding, after a 4 byte length
+SUBTYPES = {'raw': 0x80, 'zlib': 0x81, '2bit': 0x82, '4bit': 0x83}
+ENCODINGS = dict((subtype, encoding) for encoding, subtype in SUBTYPES.iteritems())
+
+# Sanger quality characters to phred scores and back
+PHRED = ''.join(chr((i - 33) % 256) for i in xrange(256))
+SANGER = ''.join(chr((i + 33) % 256) for i in xrange(256))
+
+
+def encode(mapped):
+    '''Returns the schema 2 form of a mapped document as subtraction builds it, packed sequences are upper case'''
+
+    doc = dict((field, value) for field, value in mapped.iteritems() if field not in OWNER_FIELDS)
+
+    sequence = doc.get('sequence')
+    if sequence is not None:
+        data, encoding = pack(sequence, '2bit')
+        doc['sequence'] = Binary(struct.pack('<I', len(sequence)) + data, SUBTYPES[encoding])
+    if doc.get('qqual') is not None:
+        doc['qqual'] = Binary(doc['qqual'].translate(PHRED))
+    if doc.get('cigar') is not None:
+        cigar = doc['cigar']
+        doc['cigar'] = Binary(struct.pack('<{0}I'.format(len(cigar)), *[length << 4 | op for op, length in cigar]))
+
+    doc['schema'] = SCHEMA
+
+    return doc
+
+
+def decode(doc, alignment=None):
+    '''
+    Returns a mapped document in its original schema, with the owner fields taken from
+    alignment when it is given. Schema 1 documents are returned as they are.
+    '''
+
+    if doc.get('schema') != SCHEMA:
+        return doc
+
+    doc = dict(doc)
+    del doc['schema']
+
+    sequence = doc.get('sequence')
+    if sequence is not None:
+        length, = struct.unpack_from('<I', sequence)
+        doc['sequence'] = unpack(str(sequence[4:]), ENCODINGS[sequence.subtype], length)
+    if doc.get('qqual') is not None:
+        doc['qqual'] = str(doc['qqual']).translate(SANGER)
+    if doc.get('cigar') is not None:
+        data = str(doc['cigar'])
+        # As the list of [op, length] pairs a schema 1 document reads back as
+        doc['cigar'] = [[value & 0xf, value >> 4] for value in struct.unpack('<{0}I'.format(len(data) // 4), data)]
+
+    if alignment is not None:
+        for field, source in OWNER_FIELDS.iteritems():
+            doc[field] = alignment.get(source)
+
+    return doc
+
+
+class MappedReader(object):
+    '''
+    Finds mapped documents and returns them decoded, whichever schema they were written in.
+    The owner fields are joined from the alignment of each document, which needs alignmentId
+    in the fields returned; each alignment is looked up once.
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self.alignments = {}
+
+    def alignment(self, alignment_id):
+        if alignment_id not in self.alignments:
+            self.alignments[alignment_id] = self.db.alignment.find_one({'_id': alignment_id}, dict((f, 1) for f in OWNER_FIELDS.itervalues()))
+        return self.alignments[alignment_id]
+
+    def decode(self, doc):
+        if doc.get('schema') != SCHEMA or 'alignmentId' not in doc:
+            return decode(doc)
+        return decode(doc, self.alignment(doc['alignmentId']))
+
+    def find(self, *args, **kwargs):
+        return imap(self.decode, self.db.mapped.find(*args, **kwargs))
+
+    def find_one(self, *args, **kwargs):
+        doc = self.db.mapped.find_one(*args, **kwargs)
+        return self.decode(doc) if doc is not None else None
+
+
+def main(args):
+    '''Writes the mapped reads of an alignment as FASTQ, whichever schema they were stored in'''
+
+    logger = args.logging.getLogger(__name__)
+    db = connect(args)
+
+    alignment = db.alignment.find_one({'name': args.align, 'sample': args.sample, 'projectLabel': args.project}, {'_id': 1})
+    if not alignment:
+        logger.error('Alignment {0} not found in {1}/{2}.'.format(args.align, args.project, args.sample))
+        sys.exit(1)
+
+    query = {'alignmentId': alignment['_id']}
+    if args.gi:
+        query['genome'] = int(args.gi)
+    output = args.output or args.align + '.mapped.fastq'
+
+    reader = MappedReader(db)
+    fields = dict.fromkeys(['readId', 'sequence', 'qqual', 'alignmentId', 'schema'], 1)
+    with open(output, 'w', 1 << 20) as out, stage('export mapped', logger, 'reads') as s:
+        for doc in s.meter(reader.find(query, fields)):
+            out.write('@{0}\n{1}\n+\n{2}\n'.format(doc['readId'], doc.get('sequence') or '', doc.get('qqual') or ''))
+
+    logger.info('Mapped reads of {0} written to {1}'.format(args.align, output))
+
+
+if __name__ == '__main__':
+    print 'This program should be run as part of the capsid package:\n\t$ capsid mapped -h\n\tor\n\t$ /path/to/capsid/bin/capsid mapped -h'
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+'''Duplicate marking for coordinate sorted BAM files, without Picard or a JVM'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import defaultdict, deque, namedtuple
+from itertools import count
+import math
+import re
+import time
+
+import pysam
+
+from instrument import stage
+
+
+Counter = namedtuple('Counter', ['reads', 'duplicates'])
+
+# BAM flag bits
+PAIRED = 0x1
+UNMAPPED = 0x4
+MATE_UNMAPPED = 0x8
+REVERSE = 0x10
+MATE_REVERSE = 0x20
+SECONDARY = 0x100
+DUPLICATE = 0x400
+SUPPLEMENTARY = 0x800
+
+# CIGAR operations for soft and hard clipping, and those that consume the reference
+CLIPS = (4, 5)
+REFERENCE = (0, 2, 3, 7, 8)
+CIGAR_OPS = 'MIDNSHP=X'
+cigar_regex = re.compile('(\d+)([MIDNSHP=X])')
+
+# How a buffered read is decided
+UNEXAMINED, FRAGMENT, PAIR, MATE = range(4)
+
+# Columns of the DuplicationMetrics written by Picard MarkDuplicates
+METRICS = ['LIBRARY', 'UNPAIRED_READS_EXAMINED', 'READ_PAIRS_EXAMINED', 'UNMAPPED_READS',
+           'UNPAIRED_READ_DUPLICATES', 'READ_PAIR_DUPLICATES', 'READ_PAIR_OPTICAL_DUPLICATES',
+           'PERCENT_DUPLICATION', 'ESTIMATED_LIBRARY_SIZE']
+UNKNOWN_LIBRARY = 'Unknown Library'
+
+logger = None
+
+
+def five_prime(flag, pos, cigar, end=None):
+    '''
+    Returns the unclipped 5' position of an alignment, the end of the alignment for reverse
+    strand reads. cigar is a list of (operation, length), end is computed from it when missing.
+    '''
+
+    if flag & REVERSE:
+        if end is None:
+            end = pos + sum(length for op, length in cigar if op in REFERENCE)
+        return end + sum(length for op, length in reversed(cigar[-2:]) if op in CLIPS) - 1
+    else:
+        return pos - sum(length for op, length in cigar[:2] if op in CLIPS)
+
+
+def parse_cigar(text):
+    return [(CIGAR_OPS.index(op), int(length)) for length, op in cigar_regex.findall(text)]
+
+
+def read_end(read):
+    '''Reference, unclipped 5' position and strand of a read'''
+
+    return (read.tid, five_prime(read.flag, read.pos, read.cigar or [], read.aend), bool(read.flag & REVERSE))
+
+
+def mate_end(read):
+    '''
+    Reference, unclipped 5' position and strand of the mate of a read. The mate's CIGAR comes
+    from the MC tag, without it the mate position is used as is.
+    '''
+
+    try:
+        cigar = parse_cigar(read.opt('MC'))
+    except KeyError:
+        cigar = []
+
+    # five_prime looks at the strand bit, so hand it the mate's strand
+    flag = REVERSE if read.flag & MATE_REVERSE else 0
+    return (read.rnext, five_prime(flag, read.pnext, cigar) if cigar else read.pnext, bool(read.flag & MATE_REVERSE))
+
+
+def quality_score(read):
+    '''Sum of the base qualities of at least 15, the read or pair with the highest score in a group is kept'''
+
+    # Qualities are phred + 33 characters
+    return sum(q - 33 for q in bytearray(read.qual or '') if q >= 48)
+
+
+def mate_score(read):
+    '''The quality score of the mate from the ms tag samtools fixmate -m writes, None without it'''
+
+    try:
+        return read.opt('ms')
+    except KeyError:
+        return None
+
+
+def estimate_library_size(pairs, unique):
+    '''
+    Lander-Waterman estimate of the number of unique molecules in a library, from the
+    number of read pairs and unique read pairs, as computed by Picard.
+    '''
+
+    if not pairs or not unique or unique >= pairs:
+        return None
+
+    f = lambda x: unique / x - 1 + math.exp(-pairs / x)
+    low, high = 1.0, 100.0
+    if f(low * unique) < 0:
+        return None
+    while f(high * unique) >= 0:
+        high *= 10
+
+    for i in xrange(40):
+        middle = (low + high) / 2
+        value = f(middle * unique)
+        if value == 0:
+            break
+        elif value > 0:
+            low = middle
+        else:
+            high = middle
+
+    return int(unique * (low + high) / 2)
+
+
+class DuplicateMarker(object):
+    '''
+    Marks duplicates in a stream of coordinate sorted reads, the way Picard MarkDuplicates does.
+
+    Single reads are grouped by library, reference, unclipped 5' position and strand. Pairs are
+    grouped on the same values for both ends and decided when their first read is seen, the
+    mate gets the same decision. The read or pair with the highest base quality sum is kept,
+    single reads that share their 5' end with a pair are always duplicates. As in Picard a
+    pair scores the sum of both ends: the mate's score comes from its ms tag, or is added
+    when the mate is seen before the group is decided. Without an ms tag a pair whose mate
+    lies beyond the window only scores its first read.
+
+    Reads are held in a window of window bases after their 5' position so every member of a
+    group has been seen before the group is decided, then released in their original order.
+    The only state kept beyond the window are the decisions for pairs waiting on their mate.
+    '''
+
+    def __init__(self, header, window=1000):
+        self.window = window
+        self.buffer = deque()
+        self.best = {}
+        self.members = {}
+        self.pairs = {}
+        self.closed = set()
+        self.decisions = {}
+        self.paired_ends = defaultdict(int)
+        self.paired_order = deque()
+        self.counter = Counter(count(), count())
+
+        self.libraries = dict((group['ID'], group.get('LB', UNKNOWN_LIBRARY)) for group in header.get('RG', []))
+        self.metrics = defaultdict(lambda: dict.fromkeys(METRICS[1:7], 0))
+
+    def library(self, read):
+        try:
+            return self.libraries.get(read.opt('RG'), UNKNOWN_LIBRARY)
+        except KeyError:
+            return UNKNOWN_LIBRARY
+
+    def classify(self, read):
+        '''Returns how the read is decided and its group key'''
+
+        flag = read.flag
+        if flag & (UNMAPPED | SECONDARY | SUPPLEMENTARY):
+            return UNEXAMINED, None
+
+        end = read_end(read)
+        if flag & PAIRED and not flag & MATE_UNMAPPED:
+            self.paired_ends[end] += 1
+            self.paired_order.append(end)
+            if read.qname in self.decisions:
+                return MATE, read.qname
+            self.decisions[read.qname] = None
+            return PAIR, end + mate_end(read) + (self.library(read),)
+
+        return FRAGMENT, end + (self.library(read),)
+
+    def add(self, read):
+        '''Adds the next read, yields the reads that can now be released'''
+
+        for released in self.release(read.tid, read.pos):
+            yield released
+
+        # Paired ends only matter to the single reads around them
+        while self.paired_order and (self.paired_order[0][0] != read.tid or self.paired_order[0][1] + 2 * self.window < read.pos):
+            end = self.paired_order.popleft()
+            self.paired_ends[end] -= 1
+            if not self.paired_ends[end]:
+                del self.paired_ends[end]
+
+        kind, key = self.classify(read)
+        if kind in (FRAGMENT, PAIR):
+            score = quality_score(read)
+            if kind == PAIR:
+                mate = mate_score(read)
+                if mate is None:
+                    # Waits for the mate to add its score
+                    self.pairs[read.qname] = (key, score, read)
+                else:
+                    score += mate
+            self.score(key, score, read)
+            self.members[key] = self.members.get(key, 0) + 1
+        elif kind == MATE and key in self.pairs:
+            pair_key, score, first = self.pairs.pop(key)
+            self.score(pair_key, score + quality_score(read), first)
+
+        self.buffer.append((read, kind, key))
+
+    def score(self, key, score, read):
+        '''Makes read the best of its group if it scores higher, until the first member of the group is decided'''
+
+        if key in self.closed:
+            return
+        best = self.best.get(key)
+        if best is None or score > best[0]:
+            self.best[key] = (score, read)
+
+    def decide(self, read, kind, key):
+        '''Returns True if the read is a duplicate and updates the metrics'''
+
+        if kind == UNEXAMINED:
+            if read.flag & UNMAPPED and not read.flag & (SECONDARY | SUPPLEMENTARY):
+                self.metrics[self.library(read)]['UNMAPPED_READS'] += 1
+            return False
+
+        if kind == MATE:
+            return self.decisions.pop(key)
+
+        metrics = self.metrics[key[-1]]
+        duplicate = self.best[key][1] is not read
+        self.closed.add(key)
+        self.members[key] -= 1
+        if not self.members[key]:
+            del self.members[key]
+            del self.best[key]
+            self.closed.discard(key)
+
+        if kind == PAIR:
+            # Mates seen from now on cannot change the decision
+            self.pairs.pop(read.qname, None)
+            self.decisions[read.qname] = duplicate
+            metrics['READ_PAIRS_EXAMINED'] += 1
+            metrics['READ_PAIR_DUPLICATES'] += duplicate
+        else:
+            duplicate = duplicate or key[:3] in self.paired_ends
+            metrics['UNPAIRED_READS_EXAMINED'] += 1
+            metrics['UNPAIRED_READ_DUPLICATES'] += duplicate
+
+        return duplicate
+
+    def release(self, tid=None, pos=None):
+        '''Yields buffered reads whose group is complete, all of them when tid is None'''
+
+        while self.buffer:
+            read, kind, key = self.buffer[0]
+            if tid is not None and kind in (FRAGMENT, PAIR) and key[0] == tid and key[1] + self.window >= pos:
+                break
+
+            self.buffer.popleft()
+            self.counter.reads.next()
+
+            if self.decide(read, kind, key):
+                read.flag |= DUPLICATE
+                self.counter.duplicates.next()
+            else:
+                read.flag &= ~DUPLICATE
+
+            yield read
+
+    def finish(self):
+        return self.release()
+
+    def library_metrics(self):
+        '''Yields one row of Picard DuplicationMetrics values per library'''
+
+        for library in sorted(self.metrics):
+            metrics = dict(self.metrics[library], LIBRARY=library)
+            examined = metrics['UNPAIRED_READS_EXAMINED'] + 2 * metrics['READ_PAIRS_EXAMINED']
+            duplicates = metrics['UNPAIRED_READ_DUPLICATES'] + 2 * metrics['READ_PAIR_DUPLICATES']
+            metrics['PERCENT_DUPLICATION'] = float(duplicates) / examined if examined else 0
+            metrics['ESTIMATED_LIBRARY_SIZE'] = estimate_library_size(
+                    metrics['READ_PAIRS_EXAMINED'] - metrics['READ_PAIR_OPTICAL_DUPLICATES'],
+                    metrics['READ_PAIRS_EXAMINED'] - metrics['READ_PAIR_DUPLICATES'])
+            yield metrics
+
+
+def write_metrics(path, marker, command):
+    '''Writes the metrics in the layout of the Picard MarkDuplicates METRICS_FILE'''
+
+    with open(path, 'w') as fh:
+        fh.write('## net.sf.picard.metrics.StringHeader\n')
+        fh.write('# {0}\n'.format(command))
+        fh.write('## net.sf.picard.metrics.StringHeader\n')
+        fh.write('# Started on: {0}\n\n'.format(time.strftime('%a %b %d %H:%M:%S %Z %Y')))
+        fh.write('## METRICS CLASS\tnet.sf.picard.sam.DuplicationMetrics\n')
+        fh.write('\t'.join(METRICS) + '\n')
+        for metrics in marker.library_metrics():
+            values = []
+            for name in METRICS:
+                value = metrics[name]
+                values.append('' if value is None else '{0:.6f}'.format(value) if isinstance(value, float) else str(value))
+            fh.write('\t'.join(values) + '\n')
+        fh.write('\n')
+
+
+def mark_duplicates(input_file, output_file, remove=False, window=1000, metrics_file=None):
+    '''Marks (or removes) duplicates from a coordinate sorted BAM file, returns the read and duplicate counts'''
+
+    bamfile = pysam.Samfile(input_file, 'rb')
+    out = pysam.Samfile(output_file, 'wb', template=bamfile)
+    marker = DuplicateMarker(dict(bamfile.header), window)
+
+    def write(reads):
+        for read in reads:
+            if not (remove and read.flag & DUPLICATE):
+                out.write(read)
+
+    for read in bamfile.fetch(until_eof=True):
+        write(marker.add(read))
+    write(marker.finish())
+
+    out.close()
+    bamfile.close()
+
+    if metrics_file:
+        command = 'capsid markdup INPUT={0} OUTPUT={1} METRICS_FILE={2} REMOVE_DUPLICATES={3} WINDOW={4}'.format(
+                input_file, output_file, metrics_file, str(remove).lower(), window)
+        write_metrics(metrics_file, marker, command)
+
+    # Counter starts at 0, so >it = count(); >print it.next(); >0
+    return marker.counter.reads.next(), marker.counter.duplicates.next()
+
+
+def main(args):
+    '''Marks or removes duplicate reads in a coordinate sorted BAM file'''
+
+    global logger
+
+    logger = args.logging.getLogger(__name__)
+
+    logger.info('Marking duplicates in {0}...'.format(args.input))
+    with stage('mark duplicates', logger, 'reads') as s:
+        reads, duplicates = mark_duplicates(args.input, args.output, args.remove, int(args.window), args.metrics)
+        s.add(reads)
+    logger.info('{0} of {1} reads are duplicates{2}'.format(duplicates, reads, ', removed' if args.remove else ''))
+
+    if args.index:
+        pysam.index(args.output)
+
+
+if __name__ == '__main__':
+    print 'This program should be run as part of the capsid package:\n\t$ capsid markdup -h\n\tor\n\t$ /path/to/capsid/bin/capsid markdup -h'
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+'''
+Runs subtraction, quality filtering of the unmapped reads, intersect and statistics for the
+alignments of a manifest, several at a time.
+
+The manifest is a TSV file with a header row and one row per alignment:
+
+    project  sample   alignment  xeno               ref
+    PRJ1     SAMP001  ALN1       SAMP001.xeno.bam   SAMP001.ref.bam
+
+Each alignment runs in a fresh worker process with its own MongoDB client, writing its
+unmapped reads to output/project/sample. With --threshold subtraction quality filters the
+unmapped reads as it writes them, so they are not written, read back and parsed again by
+qfilter. The alignments of a sample run in different workers and their reads only meet once
+all of them are done, so the unmapped reads of a sample are intersected from those files.
+Statistics are then calculated for the samples processed only.
+'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from argparse import Namespace
+from collections import OrderedDict
+import csv
+import errno
+import multiprocessing
+import os
+import sys
+import traceback
+
+from database import *
+from instrument import stage
+
+
+COLUMNS = ['project', 'sample', 'alignment', 'xeno', 'ref']
+
+db = None
+logger = None
+options = None
+
+
+def read_manifest(path):
+    '''Returns the rows of the manifest, with the BAM paths made absolute since workers change directory'''
+
+    with open(path) as fh:
+        reader = csv.DictReader(fh, delimiter='\t')
+        missing = set(COLUMNS) - set(reader.fieldnames or [])
+        if missing:
+            raise ValueError('Missing columns: {0}'.format(', '.join(sorted(missing))))
+
+        rows = []
+        for row in reader:
+            row = dict((column, (row[column] or '').strip()) for column in COLUMNS)
+            row['xeno'], row['ref'] = os.path.abspath(row['xeno']), os.path.abspath(row['ref'])
+            rows.append(row)
+
+    return rows
+
+
+def check_manifest(rows):
+    '''Returns the problems with the manifest rows: unknown alignments, missing BAM files and repeated rows'''
+
+    errors = []
+
+    found = db.alignment.find({'projectLabel': {'$in': list(set(r['project'] for r in rows))},
+                               'name': {'$in': list(set(r['alignment'] for r in rows))}},
+                              {'_id': 0, 'projectLabel': 1, 'sample': 1, 'name': 1})
+    alignments = set((a['projectLabel'], a['sample'], a['name']) for a in found)
+
+    seen = set()
+    for row in rows:
+        key = (row['project'], row['sample'], row['alignment'])
+        if key in seen:
+            errors.append('Alignment {2} of {0}/{1} is listed twice in the manifest'.format(*key))
+        seen.add(key)
+        if key not in alignments:
+            # As subtraction reports it
+            errors.append('Alignment {2} not found in {0}/{1}.'.format(*key))
+        for bam in (row['xeno'], row['ref']):
+            if not os.path.isfile(bam):
+                errors.append('BAM file {0} of alignment {1} does not exist'.format(bam, row['alignment']))
+
+    return errors
+
+
+def sample_directory(project, sample):
+    directory = os.path.join(options.output, project, sample)
+    try:
+        os.makedirs(directory)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    return directory
+
+
+def init_worker(args):
+    '''Workers get the options when they start, args holds the logging module and cannot be sent with each task'''
+
+    global options, logger
+
+    options = args
+    logger = args.logging.getLogger(__name__)
+
+
+def run_task(func, *args):
+    '''
+    Runs func in a worker and returns None, or the error that stopped it. Subcommands exit
+    on errors, which would otherwise take the pool worker down with them.
+    '''
+
+    try:
+        func(*args)
+    except SystemExit, e:
+        if e.code:
+            return 'exited with status {0}'.format(e.code)
+    except Exception, e:
+        logger.debug(traceback.format_exc())
+        return '{0}: {1}'.format(type(e).__name__, e)
+
+
+def process_alignment(row):
+    '''Loads the mapped reads of an alignment and writes its unmapped reads, quality filtered with --threshold'''
+
+    import subtraction
+
+    os.chdir(sample_directory(row['project'], row['sample']))
+
+    args = Namespace(**vars(options))
+    args.xeno, args.ref, args.align = row['xeno'], row['ref'], row['alignment']
+    args.sample, args.project = row['sample'], row['project']
+    args.process = 'both'
+    args.gra = False
+    args.lookup, args.xeno_lookup, args.ref_lookup = None, [None, None], [None, None]
+    args.temp = os.path.join(options.temp, '')
+    # intersect reads one unmapped reads file per alignment
+    args.unmapped_dir, args.compress, args.interleave = '.', None, True
+    subtraction.main(args)
+
+
+def alignment_task(row):
+    return row, run_task(process_alignment, row)
+
+
+def unmapped_file(row):
+    # As subtraction names the file with and without the quality filter
+    suffix = '.unmapped.quality.fastq' if options.threshold is not None else '.unmapped.fastq'
+    return os.path.join(sample_directory(row['project'], row['sample']), row['alignment'] + suffix)
+
+
+def intersect_sample(rows):
+    '''Intersects the unmapped reads of the alignments of a sample'''
+
+    import intersect
+
+    os.chdir(sample_directory(rows[0]['project'], rows[0]['sample']))
+
+    args = Namespace(**vars(options))
+    args.files = [unmapped_file(row) for row in rows]
+    intersect.main(args)
+
+
+def intersect_task(rows):
+    return rows[0], run_task(intersect_sample, rows)
+
+
+def main(args):
+    '''Runs the pipeline for the alignments of a manifest'''
+
+    global db, logger, options
+
+    logger = args.logging.getLogger(__name__)
+    db = connect(args)
+
+    # Workers change into the sample directories
+    args.output = os.path.abspath(args.output)
+    args.temp = os.path.abspath(args.temp)
+    if args.sidecar:
+        args.sidecar = os.path.abspath(args.sidecar)
+    options = args
+
+    try:
+        rows = read_manifest(args.manifest)
+    except (IOError, ValueError), e:
+        logger.error('Cannot read manifest {0}: {1}'.format(args.manifest, e))
+        sys.exit(1)
+
+    errors = check_manifest(rows)
+    for error in errors:
+        logger.error(error)
+    if errors:
+        sys.exit(1)
+
+    failed = []
+
+    # A fresh process for each alignment, the subcommand modules keep their state in globals
+    logger.info('Processing {0} alignments, {1} at a time...'.format(len(rows), args.jobs))
+    pool = multiprocessing.Pool(int(args.jobs), initializer=init_worker, initargs=(args,), maxtasksperchild=1)
+    with stage('subtraction', logger, 'alignments') as s:
+        for row, error in s.meter(pool.imap_unordered(alignment_task, rows)):
+            if error:
+                failed.append((row, error))
+                logger.error('Alignment {alignment} of {project}/{sample} failed: '.format(**row) + error)
+            else:
+                logger.info('Alignment {alignment} of {project}/{sample} done'.format(**row))
+
+    samples = OrderedDict()
+    failed_samples = set((row['project'], row['sample']) for row, error in failed)
+    for row in rows:
+        if (row['project'], row['sample']) not in failed_samples:
+            samples.setdefault((row['project'], row['sample']), []).append(row)
+
+    with stage('intersect', logger, 'samples') as s:
+        tasks = [sample_rows for sample_rows in samples.itervalues() if len(sample_rows) > 1]
+        for row, error in s.meter(pool.imap_unordered(intersect_task, tasks)):
+            if error:
+                failed.append((row, error))
+                logger.error('Intersecting the unmapped reads of {project}/{sample} failed: '.format(**row) + error)
+    pool.close()
+    pool.join()
+
+    if samples and not args.skip_statistics:
+        import statistics
+
+        done = [db.alignment.find_one({'projectLabel': project, 'sample': sample}, {'sampleId': 1})['sampleId']
+                for project, sample in samples]
+        with stage('statistics', logger, 'samples') as s:
+            statistics.update_samples(args, done)
+            s.add(len(done))
+
+    if failed:
+        logger.error('{0} of {1} alignments or samples failed'.format(len(failed), len(rows)))
+        sys.exit(1)
+
+    logger.info('Done.')
+
+
+if __name__ == '__main__':
+    print 'This program should be run as part of the capsid package:\n\t$ capsid pipeline -h\n\tor\n\t$ /path/to/capsid/bin/capsid pipeline -h'
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+'''
+CPU profiles of a subcommand for --profile, with cProfile or a SIGPROF sampling profiler.
+
+Every process writes its own file to ~/.capsid/profiles: pstats files (.prof) from cProfile,
+collapsed stacks (.collapsed) for flamegraph.pl from the sampler. Processes forked by
+multiprocessing, such as the statistics pool workers, start their own profile and write
+it when they exit.
+'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import defaultdict
+import cProfile
+import errno
+import multiprocessing.util
+import os
+import signal
+import time
+
+from defaults import PROFILE_MODES as MODES
+
+
+PROFILE_DIR = '~/.capsid/profiles'
+# Seconds of CPU time between samples
+SAMPLE_INTERVAL = 0.005
+
+profiler = None
+prefix = None
+logger = None
+
+
+class CProfiler(object):
+    '''Deterministic profile of every call, written as a pstats file'''
+
+    extension = '.prof'
+
+    def __init__(self, interval=None):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self, path):
+        self.profile.disable()
+        self.profile.dump_stats(path)
+
+
+class Sampler(object):
+    '''
+    Samples the Python stack of the main thread every interval seconds of CPU time, written
+    as collapsed stacks. Cheap enough to leave on for a production run.
+    '''
+
+    extension = '.collapsed'
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = defaultdict(int)
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{0} ({1}:{2})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        # Restart system calls the signal interrupts instead of failing them with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self, path):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        with open(path, 'w') as fh:
+            for stack, samples in sorted(self.stacks.iteritems()):
+                fh.write('{0} {1}\n'.format(stack, samples))
+
+
+def stop():
+    '''Stops the profile of this process and writes it, returns the path of the file'''
+
+    global profiler
+
+    if profiler is None or profiler.pid != os.getpid():
+        return None
+
+    path = '{0}-{1}{2}'.format(prefix, os.getpid(), profiler.extension)
+    profiler.stop(path)
+    profiler = None
+    logger.info('Profile written to {0}'.format(path))
+
+    return path
+
+
+def after_fork(inherited):
+    '''Replaces the profile inherited by a process forked by multiprocessing with its own'''
+
+    global profiler
+
+    if isinstance(inherited, CProfiler):
+        inherited.profile.disable()
+
+    profiler = type(inherited)(getattr(inherited, 'interval', None))
+    profiler.pid = os.getpid()
+    profiler.start()
+    multiprocessing.util.Finalize(None, stop, exitpriority=10)
+    multiprocessing.util.register_after_fork(profiler, after_fork)
+
+
+def start(args):
+    '''Starts profiling this process when --profile is given'''
+
+    global profiler, prefix, logger
+
+    if not getattr(args, 'profile', None):
+        return
+
+    logger = args.logging.getLogger(__name__)
+
+    directory = os.path.expanduser(PROFILE_DIR)
+    try:
+        os.makedirs(directory)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # Files of one run share the command and start time, and end with the pid of their process
+    prefix = os.path.join(directory, '{0}-{1}'.format(args.func.__name__.rstrip('_'), time.strftime('%Y%m%d-%H%M%S')))
+
+    if args.profile == 'sample':
+        profiler = Sampler(args.profile_interval / 1000.0)
+    else:
+        profiler = CProfiler()
+    profiler.pid = os.getpid()
+    profiler.start()
+    multiprocessing.util.register_after_fork(profiler, after_fork)
+
+
+if __name__ == '__main__':
+    print 'This program should be run as part of the capsid package:\n\t$ capsid --profile sample <command> -h\n\tor\n\t$ /path/to/capsid/bin/capsid --profile sample <command> -h'
@@ -16,6 +16,8 @@ import subprocess
 
 from Bio import SeqIO
 
+from instrument import stage
+
 Records = namedtuple('Records', ['single', 'pair'])
 FileName = namedtuple('FileName', ['name', 'dot', 'ext'])
 Counter = namedtuple('Counter', ['records', 'saved'])
@@ -52,20 +54,21 @@ def make_filtered_fastq_files(args, records):
     fh_single = open(ft_single, 'w')
     fh_pair = open(ft_pair, 'w') if f_pair else None
 
-    for record in records:
-        counter.saved.next()
-        fh_single.write('@{description}\n{seq}\n+{description}\n{quality}\n'.format(
-            description = record.single.description,
-            seq = record.single.seq,
-            quality = SeqIO.QualityIO._get_sanger_quality_str(record.single))
-            )
-
-        if f_pair:
-            fh_pair.write('@{description}\n{seq}\n+{description}\n{quality}\n'.format(
-                description = record.pair.description,
-                seq = record.pair.seq,
-                quality = SeqIO.QualityIO._get_sanger_quality_str(record.pair))
+    with stage('quality filter', logger, 'records') as s:
+        for record in s.meter(records):
+            counter.saved.next()
+            fh_single.write('@{description}\n{seq}\n+{description}\n{quality}\n'.format(
+                description = record.single.description,
+                seq = record.single.seq,
+                quality = SeqIO.QualityIO._get_sanger_quality_str(record.single))
                 )
+
+            if f_pair:
+                fh_pair.write('@{description}\n{seq}\n+{description}\n{quality}\n'.format(
+                    description = record.pair.description,
+                    seq = record.pair.seq,
+                    quality = SeqIO.QualityIO._get_sanger_quality_str(record.pair))
+                    )
  
     fh_single.close()
     if fh_pair: fh_pair.close()
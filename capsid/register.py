@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+'''
+Registers the projects, samples and alignments of a TSV or JSON manifest in one run.
+
+A TSV manifest has a header row and an entity column (project, sample or alignment), the
+other columns are named after the options of `capsid project`, `capsid sample` and
+`capsid alignment`:
+
+    entity     project  sample   alignment  name        platform  type
+    project    PRJ1                         Project 1
+    sample     PRJ1     SAMP001
+    alignment  PRJ1     SAMP001  ALN1                   Illumina  Paired End
+
+A JSON manifest is an object with projects, samples and alignments lists of objects with
+the same fields. Empty fields are left unset, as they are when the option is not given.
+'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from argparse import Namespace
+from collections import OrderedDict
+import csv
+import json
+import sys
+
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from database import *
+import alignment
+import project
+import sample
+
+
+ENTITIES = ['project', 'sample', 'alignment']
+
+# Manifest fields and the argument of the single record commands they stand for
+FIELDS = {
+    'project': {'project': 'project', 'name': 'pname', 'desc': 'pdesc', 'link': 'link'}
+    , 'sample': {'sample': 'sample', 'project': 'project', 'desc': 'sdesc', 'role': 'role',
+                 'source': 'source', 'cancer': 'cancer'}
+    , 'alignment': {'alignment': 'align', 'sample': 'sample', 'project': 'project', 'aligner': 'aligner',
+                    'platform': 'platform', 'type': 'type', 'infile': 'infile', 'outfile': 'outfile'}
+    }
+REQUIRED = {'project': ['project'], 'sample': ['sample', 'project'], 'alignment': ['alignment', 'sample', 'project']}
+
+# Worded like the DuplicateKeyError messages of capsid project, sample and alignment
+EXISTS = {
+    'project': 'Project {project} already exists'
+    , 'sample': 'Sample {sample} already exists in project: {project}'
+    , 'alignment': 'Alignment {align} already exists in {project}/{sample}'
+    }
+
+db, logger = None, None
+
+
+def read_manifest(path):
+    '''Returns the records of a TSV or JSON manifest as {entity: [fields]}'''
+
+    records = dict((entity, []) for entity in ENTITIES)
+
+    with open(path) as fh:
+        if path.endswith('.json'):
+            manifest = json.load(fh)
+            for entity in ENTITIES:
+                records[entity] = manifest.get(entity + 's', [])
+        else:
+            reader = csv.DictReader(fh, delimiter='\t')
+            unknown = set(reader.fieldnames or []) - set(['entity']) - set(f for fields in FIELDS.itervalues() for f in fields)
+            if unknown:
+                raise ValueError('Unknown columns: {0}'.format(', '.join(sorted(unknown))))
+            for row in reader:
+                entity = (row.pop('entity') or '').strip().lower()
+                if entity not in records:
+                    raise ValueError('Unknown entity {0!r}, expected one of {1}'.format(entity, ', '.join(ENTITIES)))
+                records[entity].append(row)
+
+    return records
+
+
+def to_args(entity, record):
+    '''Turns a manifest record into the arguments the create_* functions take'''
+
+    # A TSV row has every column, those of other entities are left empty
+    unknown = set(field for field, value in record.iteritems() if field not in FIELDS[entity] and value not in (None, ''))
+    if unknown:
+        raise ValueError('Unknown {0} fields: {1}'.format(entity, ', '.join(sorted(unknown))))
+
+    values = dict((name, None) for name in FIELDS[entity].itervalues())
+    for field, value in record.iteritems():
+        if field not in FIELDS[entity]:
+            continue
+        if isinstance(value, basestring):
+            value = value.strip() or None
+        values[FIELDS[entity][field]] = value
+
+    missing = [field for field in REQUIRED[entity] if not values[FIELDS[entity][field]]]
+    if missing:
+        raise ValueError('{0} record without {1}: {2}'.format(entity.capitalize(), ', '.join(missing), json.dumps(record, sort_keys=True)))
+
+    return Namespace(**values)
+
+
+def find_existing(labels, sample_names, alignment_names):
+    '''
+    Looks up the projects, samples and alignments the manifest names with one $in query
+    for each, returns them keyed as the manifest refers to them.
+    '''
+
+    projects = dict((p['label'], p) for p in db.project.find({'label': {'$in': list(labels)}}))
+    project_ids = [p['_id'] for p in projects.itervalues()]
+    labels_by_id = dict((p['_id'], label) for label, p in projects.iteritems())
+
+    samples, alignments = {}, {}
+    if project_ids and sample_names:
+        for s in db.sample.find({'projectId': {'$in': project_ids}, 'name': {'$in': list(sample_names)}}):
+            samples[(labels_by_id[s['projectId']], s['name'])] = s
+    if project_ids and alignment_names:
+        for a in db.alignment.find({'projectId': {'$in': project_ids}, 'name': {'$in': list(alignment_names)}}, {'_id': 0, 'projectId': 1, 'sample': 1, 'name': 1}):
+            alignments[(labels_by_id[a['projectId']], a['sample'], a['name'])] = a
+
+    return projects, samples, alignments
+
+
+def plan(records, skip_existing):
+    '''
+    Checks the manifest against itself and the database, returns the records to insert
+    and the errors found. Records that already exist are errors, or skipped with skip_existing.
+    '''
+
+    errors = []
+    args = dict((entity, [to_args(entity, record) for record in records[entity]]) for entity in ENTITIES)
+
+    keys = {
+        'project': lambda a: a.project
+        , 'sample': lambda a: (a.project, a.sample)
+        , 'alignment': lambda a: (a.project, a.sample, a.align)
+        }
+    labels = set(a.project for entity in ENTITIES for a in args[entity])
+    existing = dict(zip(ENTITIES, find_existing(labels, set(a.sample for a in args['sample'] + args['alignment']),
+                                                set(a.align for a in args['alignment']))))
+
+    new = dict((entity, []) for entity in ENTITIES)
+    for entity in ENTITIES:
+        seen = set()
+        for a in args[entity]:
+            key = keys[entity](a)
+            if key in seen:
+                errors.append('{0} {1} is listed twice in the manifest'.format(entity.capitalize(), '/'.join(key) if isinstance(key, tuple) else key))
+                continue
+            seen.add(key)
+
+            if key in existing[entity]:
+                message = EXISTS[entity].format(**vars(a))
+                if skip_existing:
+                    logger.warning(message + ', skipped')
+                else:
+                    errors.append(message)
+                continue
+
+            new[entity].append(a)
+
+    new_projects = set(a.project for a in new['project'])
+    new_samples = set((a.project, a.sample) for a in new['sample'])
+    for a in new['sample'] + new['alignment']:
+        if a.project not in existing['project'] and a.project not in new_projects:
+            errors.append('Project {0} does not exists'.format(a.project))
+    for a in new['alignment']:
+        if (a.project, a.sample) not in existing['sample'] and (a.project, a.sample) not in new_samples:
+            errors.append('Sample {0} does not exist in project: {1}'.format(a.sample, a.project))
+
+    # A missing project is reported once, however many records refer to it
+    return new, existing, list(OrderedDict.fromkeys(errors))
+
+
+def with_id(doc):
+    '''Gives a document its _id before it is inserted, so a failed register knows what to remove'''
+
+    doc['_id'] = ObjectId()
+    return doc
+
+
+def rollback(inserted):
+    '''Removes the documents of a failed register, children first, by the _ids they were given'''
+
+    for collection, docs in reversed(inserted):
+        ids = [doc['_id'] for doc in docs]
+        try:
+            collection.remove({'_id': {'$in': ids}})
+        except PyMongoError, e:
+            logger.error('Could not remove {0} {1} documents that may have been registered: {2}'.format(len(ids), collection.name, e))
+            logger.error('{0} _ids: {1}'.format(collection.name, ', '.join(str(i) for i in ids)))
+
+
+def register(new, existing):
+    '''
+    Inserts the new records with bulk writes, parents first, returns the number of each.
+    If an insert fails the documents already inserted are removed again and the error re-raised.
+    '''
+
+    projects = dict(existing['project'])
+    project_docs = []
+    for a in new['project']:
+        projects[a.project] = with_id(project.create_project(a))
+        project_docs.append(projects[a.project])
+    role_docs = [with_id(project.create_role(a)) for a in new['project']]
+
+    samples = dict(existing['sample'])
+    sample_docs = []
+    for a in new['sample']:
+        samples[(a.project, a.sample)] = with_id(sample.create_sample(projects[a.project], a))
+        sample_docs.append(samples[(a.project, a.sample)])
+
+    alignment_docs = [with_id(alignment.create_alignment(projects[a.project], samples[(a.project, a.sample)], a)) for a in new['alignment']]
+
+    inserted = []
+    try:
+        for collection, docs in [(db.project, project_docs), (db.role, role_docs), (db.sample, sample_docs), (db.alignment, alignment_docs)]:
+            # Part of a batch may be in before the insert fails
+            inserted.append((collection, docs))
+            bulk_insert(collection, docs)
+    except PyMongoError:
+        logger.error('Registering failed, removing the records inserted so far...')
+        rollback(inserted)
+        raise
+
+    return len(project_docs), len(sample_docs), len(alignment_docs)
+
+
+def main(args):
+    '''Registers the projects, samples and alignments of a manifest'''
+
+    global db, logger
+
+    logger = args.logging.getLogger(__name__)
+    db = connect(args)
+
+    try:
+        records = read_manifest(args.manifest)
+        new, existing, errors = plan(records, args.skip_existing)
+    except (IOError, ValueError), e:
+        logger.error('Cannot read manifest {0}: {1}'.format(args.manifest, e))
+        sys.exit(1)
+
+    for error in errors:
+        logger.error(error)
+    if errors:
+        logger.error('Nothing was registered, {0} problems in {1}'.format(len(errors), args.manifest))
+        sys.exit(1)
+
+    if args.dry_run:
+        logger.info('Would register {0} projects, {1} samples and {2} alignments'.format(*[len(new[entity]) for entity in ENTITIES]))
+        return
+
+    try:
+        counts = register(new, existing)
+    except DuplicateKeyError, e:
+        # Registered by someone else since the manifest was checked
+        logger.error('A record of {0} already exists, nothing was registered: {1}'.format(args.manifest, e))
+        sys.exit(1)
+    except PyMongoError, e:
+        logger.error('Could not register {0}: {1}'.format(args.manifest, e))
+        sys.exit(1)
+
+    logger.info('Registered {0} projects, {1} samples and {2} alignments'.format(*counts))
+
+
+if __name__ == '__main__':
+    print 'This program should be run as part of the capsid package:\n\t$ capsid register -h\n\tor\n\t$ /path/to/capsid/bin/capsid register -h'
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+'''Converts SAM files into a merged, coordinate sorted, duplicate marked and indexed BAM file'''
 
 
 # Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
@@ -7,39 +8,238 @@
 # terms of the GNU Public License v3.0.
 #
 # You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from itertools import count
+import heapq
 import os
+import shutil
+import sys
+import tempfile
 
-import capsid
+import pysam
+
+from defaults import SORT_CHUNK_SIZE as CHUNK_SIZE, MERGE_BATCH_SIZE
+from instrument import stage
+import markdup
+
+logger = None
+
+
+def open_bam(path, mode, threads=1, **kwargs):
+    '''Opens an alignment file, with multithreaded BGZF compression where pysam supports it'''
+
+    if threads > 1:
+        try:
+            return pysam.Samfile(path, mode, threads=threads, **kwargs)
+        except TypeError:
+            pass
+
+    return pysam.Samfile(path, mode, **kwargs)
+
+
+def run_stage(name, func, *args):
+    '''Runs one stage of the pipeline and logs its duration, exits if the stage fails'''
+
+    logger.info('Running {0}...'.format(name))
+
+    try:
+        with stage(name, logger):
+            return func(*args)
+    except (IOError, OSError, ValueError, pysam.SamtoolsError), e:
+        logger.error('{0} failed: {1}'.format(name, e))
+        sys.exit(1)
+
+
+def sort_key(read):
+    '''Coordinate order, reads without a reference go last'''
+
+    return (read.tid if read.tid >= 0 else sys.maxint, read.pos)
+
+
+def check_references(template, samfile, f):
+    '''All inputs must be aligned against the same references, in the same order'''
+
+    if samfile.references != template.references or samfile.lengths != template.lengths:
+        raise ValueError('{0} was aligned against different references than {1}'.format(f, template.filename))
+
+
+def merge_headers(headers):
+    '''
+    Combines the headers of all inputs: the first input's HD and SQ lines with the RG, PG and
+    CO lines of every input. Read groups must agree on the same ID since reads keep their RG tags,
+    programs sharing an ID with different details get a suffix as in samtools merge.
+    '''
+
+    header = dict((key, headers[0][key]) for key in ('HD', 'SQ') if key in headers[0])
+    header['HD'] = dict(header.get('HD', {'VN': '1.0'}))
+    header['HD']['SO'] = 'coordinate'
+
+    groups = {}
+    programs = {}
+    comments = set()
+
+    for h in headers:
+        for group in h.get('RG', []):
+            if group['ID'] not in groups:
+                groups[group['ID']] = group
+                header.setdefault('RG', []).append(group)
+            elif groups[group['ID']] != group:
+                raise ValueError('Read group {0} differs between input files'.format(group['ID']))
+
+        for program in h.get('PG', []):
+            if program in programs.values():
+                continue
+            name = program['ID']
+            suffix = count(1)
+            while name in programs:
+                name = '{0}-{1}'.format(program['ID'], suffix.next())
+            programs[name] = program
+            header.setdefault('PG', []).append(dict(program, ID=name))
+
+        for comment in h.get('CO', []):
+            if comment not in comments:
+                comments.add(comment)
+                header.setdefault('CO', []).append(comment)
+
+    return header
+
+
+def write_chunk(reads, template, directory, number):
+    '''Sorts the reads and writes them to an uncompressed temporary BAM file, returns its path'''
+
+    reads.sort(key=sort_key)
+    path = os.path.join(directory, 'chunk{0:05d}.bam'.format(number))
+
+    out = pysam.Samfile(path, 'wbu', template=template)
+    for read in reads:
+        out.write(read)
+    out.close()
+
+    return path
+
+
+def convert(files, directory, chunk_size):
+    '''
+    Streams the reads of all SAM files into sorted chunks of at most chunk_size reads, returns the
+    chunk paths and the merged header of all files
+    '''
+
+    template = None
+    headers = []
+    chunks = []
+    reads = []
+    total = 0
+
+    for f in files:
+        samfile = pysam.Samfile(f, 'r')
+        if template is None:
+            template = samfile
+        else:
+            check_references(template, samfile, f)
+        headers.append(samfile.header.to_dict())
+
+        for read in samfile.fetch(until_eof=True):
+            reads.append(read)
+            if len(reads) == chunk_size:
+                chunks.append(write_chunk(reads, template, directory, len(chunks)))
+                total += len(reads)
+                reads = []
+
+        if samfile is not template:
+            samfile.close()
+
+    if template is None:
+        raise ValueError('No SAM files given')
+
+    if reads or not chunks:
+        chunks.append(write_chunk(reads, template, directory, len(chunks)))
+        total += len(reads)
+
+    template.close()
+    logger.debug('{0} reads in {1} sorted chunks'.format(total, len(chunks)))
+
+    return chunks, merge_headers(headers)
+
+
+def keyed_reads(bamfile, number):
+    '''
+    The chunk number keeps reads with equal keys in input order, also across merge passes of
+    consecutive batches, and stops heapq from comparing reads
+    '''
+
+    for read in bamfile.fetch(until_eof=True):
+        yield sort_key(read), number, read
+
+
+def merge_chunks(chunks, output, header, mode, threads=1):
+    '''Merges sorted chunks into one sorted file'''
+
+    inputs = [pysam.Samfile(chunk, 'rb') for chunk in chunks]
+
+    streams = [keyed_reads(bamfile, n) for n, bamfile in enumerate(inputs)]
+
+    out = open_bam(output, mode, threads, header=header)
+    for key, n, read in heapq.merge(*streams):
+        out.write(read)
+    out.close()
+
+    for bamfile in inputs:
+        bamfile.close()
+
+
+def merge(chunks, header, output, threads, directory, batch_size=MERGE_BATCH_SIZE):
+    '''
+    Merges the sorted chunks into one coordinate sorted BAM file. With more than batch_size chunks,
+    consecutive batches are first merged into larger temporary chunks, so no more than batch_size
+    files are open at once.
+    '''
+
+    passes = count(1)
+    while len(chunks) > batch_size:
+        n = passes.next()
+        merged = []
+        for i in xrange(0, len(chunks), batch_size):
+            path = os.path.join(directory, 'merge{0:02d}-{1:05d}.bam'.format(n, len(merged)))
+            merge_chunks(chunks[i:i + batch_size], path, header, 'wbu')
+            for chunk in chunks[i:i + batch_size]:
+                os.remove(chunk)
+            merged.append(path)
+        logger.debug('Merge pass {0}: {1} chunks into {2}'.format(n, len(chunks), len(merged)))
+        chunks = merged
+
+    merge_chunks(chunks, output, header, 'wb', threads)
+
+
+def remove_duplicates(sorted_bam, marked_bam, remove, metrics_file):
+    reads, duplicates = markdup.mark_duplicates(sorted_bam, marked_bam, remove, metrics_file=metrics_file)
+    logger.info('{0} of {1} reads are duplicates{2}'.format(duplicates, reads, ', removed' if remove else ''))
 
 
 def main(args):
-    '''Converts Sam files into BAM files and collapses them using Picard'''
+    '''Converts SAM files into a sorted BAM file with duplicates marked or removed'''
+
+    global logger
 
     logger = args.logging.getLogger(__name__)
-    picard = args.picard or '.'
-    files = args.files
+    markdup.logger = logger
 
-    for f in files:
-        # Convert Sam to Bam
-        logger.info('Converting {0} to bam...'.format(f))
-        os.system('samtools view -bS -o ' + f + '.bam ' + f)
-
-    # Merge all Bam files
-    logger.info('Merging bam files...')
-    os.system('samtools merge merged.bam ' + " ".join([f+'.bam' for f in files]))
-    # Sort bam file alignment by left most coordinate
-    logger.info('Sorting...')
-    os.system('samtools sort merged.bam merged.sorted')
-    # Index sorted alignments for fast random access - creates .bai file
-    logger.info('Indexing...')
-    os.system('samtools index merged.sorted.bam')
-    # Remove duplicates using Picard
-    logger.info('Removing duplicates with Picard...')
-    os.system('java -jar {0}/MarkDuplicates.jar INPUT=merged.sorted.bam OUTPUT=merged.sorted.marked.bam METRICS_FILE=duplicateMETRICS.txt REMOVE_DUPLICATES=true ASSUME_SORTED=true VALIDATION_STRINGENCY=LENIENT'.format(picard))
-    logger.info('Indexing final bam file...')
-    os.system('samtools index merged.sorted.marked.bam')
+    sorted_bam = args.output + '.sorted.bam'
+    marked_bam = args.output + '.sorted.marked.bam'
+    metrics_file = os.path.join(os.path.dirname(args.output), 'duplicateMETRICS.txt')
+    threads = int(args.threads)
+    directory = tempfile.mkdtemp(prefix='sam2bam', dir=args.temp)
+
+    try:
+        chunks, header = run_stage('convert and sort', convert, args.files, directory, int(args.chunk_size))
+        run_stage('merge sorted chunks', merge, chunks, header, sorted_bam, threads, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    run_stage('index sorted BAM', pysam.index, sorted_bam)
+    run_stage('mark duplicates', remove_duplicates, sorted_bam, marked_bam, not args.keep_duplicates, metrics_file)
+    run_stage('index marked BAM', pysam.index, marked_bam)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+'''Chunked genome sequence storage in MongoDB, with optional 2-bit/4-bit packing or zlib compression'''
+
+
+# Copyright 2011(c) The Ontario Institute for Cancer Research. All rights reserved.
+#
+# This program and the accompanying materials are made available under the
+# terms of the GNU Public License v3.0.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from itertools import count
+from collections import namedtuple
+import zlib
+
+import numpy
+import pymongo
+import gridfs
+from bson.binary import Binary
+
+from database import *
+from defaults import SEQUENCE_CHUNK_SIZE as CHUNK_SIZE, SEQUENCE_ENCODINGS as ENCODINGS
+
+
+# Alphabets for the packed encodings, the position in the string is the code
+TWO_BIT = 'ACGT'
+FOUR_BIT = 'ACGTNRYKMSWBDHV-'
+
+Counter = namedtuple('Counter', ['genomes', 'migrated'])
+
+logger = None
+counter = Counter(count(), count())
+
+
+def code_table(alphabet):
+    '''Returns a 256 entry lookup table from byte to code, 255 marks bytes outside the alphabet'''
+
+    table = numpy.empty(256, numpy.uint8)
+    table.fill(255)
+    for code, base in enumerate(alphabet):
+        table[ord(base)] = code
+        table[ord(base.lower())] = code
+
+    return table
+
+
+TABLES = {'2bit': code_table(TWO_BIT), '4bit': code_table(FOUR_BIT)}
+SYMBOLS = {'2bit': numpy.fromstring(TWO_BIT, numpy.uint8), '4bit': numpy.fromstring(FOUR_BIT, numpy.uint8)}
+BITS = {'2bit': 2, '4bit': 4}
+
+
+def pack(seq, encoding):
+    '''
+    Encodes a sequence string, returns the packed data and the encoding actually used.
+    Sequences that cannot be packed with 2 bits fall back to 4 bits, and then to zlib.
+    The packed encodings do not keep the case of the bases.
+    '''
+
+    if encoding == 'raw':
+        return seq, encoding
+    if encoding == 'zlib':
+        return zlib.compress(seq, 6), encoding
+
+    codes = TABLES[encoding][numpy.frombuffer(seq, numpy.uint8)]
+    if len(codes) and codes.max() == 255:
+        return pack(seq, '4bit' if encoding == '2bit' else 'zlib')
+
+    bits = BITS[encoding]
+    per_byte = 8 // bits
+    padded = numpy.zeros(-(-len(codes) // per_byte) * per_byte, numpy.uint8)
+    padded[:len(codes)] = codes
+
+    packed = numpy.zeros(len(padded) // per_byte, numpy.uint8)
+    for i in xrange(per_byte):
+        packed |= padded[i::per_byte] << (8 - bits * (i + 1))
+
+    return packed.tostring(), encoding
+
+
+def unpack(data, encoding, length):
+    '''Decodes the data of a chunk back into a sequence string of the given length'''
+
+    if encoding == 'raw':
+        return str(data)
+    if encoding == 'zlib':
+        return zlib.decompress(data)
+
+    bits = BITS[encoding]
+    per_byte = 8 // bits
+    mask = (1 << bits) - 1
+    packed = numpy.frombuffer(data, numpy.uint8)
+
+    codes = numpy.empty(len(packed) * per_byte, numpy.uint8)
+    for i in xrange(per_byte):
+        codes[i::per_byte] = (packed >> (8 - bits * (i + 1))) & mask
+
+    return SYMBOLS[encoding][codes[:length]].tostring()
+
+
+class SequenceStore(object):
+    '''
+    Stores each genome sequence as a few large chunk documents in the sequence collection,
+    {genome, start, end, encoding, data}, with 0-based half open [start, end) coordinates.
+    Genomes that were loaded before the store existed are read from GridFS instead.
+    '''
+
+    def __init__(self, db, collection='sequence'):
+        self.collection = db[collection]
+        self.collection.ensure_index([('genome', pymongo.ASCENDING), ('start', pymongo.ASCENDING)], unique=True)
+        self.fs = gridfs.GridFS(db)
+
+    def put(self, gi, seq, encoding='raw', chunk_size=CHUNK_SIZE):
+        '''Saves the sequence for a genome, split into chunks of chunk_size bases'''
+
+        chunks = []
+        for start in xrange(0, len(seq), chunk_size):
+            data, used = pack(seq[start:start + chunk_size], encoding)
+            chunks.append({
+                "genome": int(gi)
+                , "start": start
+                , "end": min(start + chunk_size, len(seq))
+                , "encoding": used
+                , "data": Binary(data)
+                })
+
+        if chunks:
+            self.collection.insert(chunks)
+
+    def delete(self, gi):
+        '''Removes the sequence for a genome, including any copies left in GridFS'''
+
+        self.collection.remove({'genome': int(gi)})
+        for grid_out in self.fs.find({'filename': str(gi)}):
+            self.fs.delete(grid_out._id)
+
+    def exists(self, gi):
+        '''Checks if the genome has a sequence in the store, GridFS is not checked'''
+
+        return self.collection.find_one({'genome': int(gi)}, {'_id': 1}) is not None
+
+    def length(self, gi):
+        '''Returns the number of bases stored for a genome, from the coordinates of its chunks'''
+
+        return sum(chunk['end'] - chunk['start'] for chunk in self.collection.find({'genome': int(gi)}, {'_id': 0, 'start': 1, 'end': 1}))
+
+    def chunks(self, gi, start=0, end=None):
+        '''Yields the sequence of a genome between start and end (0-based, end exclusive) in chunk sized pieces'''
+
+        query = {'genome': int(gi), 'end': {'$gt': start}}
+        if end is not None:
+            query['start'] = {'$lt': end}
+
+        found = False
+        for chunk in self.collection.find(query).sort('start', pymongo.ASCENDING):
+            found = True
+            seq = unpack(chunk['data'], chunk['encoding'], chunk['end'] - chunk['start'])
+            offset = chunk['start']
+            yield seq[max(start - offset, 0):None if end is None else end - offset]
+
+        if not found and not self.exists(gi) and self.fs.exists(filename=str(gi)):
+            seq = self.fs.get_last_version(str(gi)).read()
+            yield seq[start:end]
+
+    def get(self, gi, start=0, end=None):
+        '''Returns the sequence of a genome between start and end (0-based, end exclusive)'''
+
+        return ''.join(self.chunks(gi, start, end))
+
+    def wrap(self, gi, width=80):
+        '''Yields the sequence of a genome as blocks of newline terminated lines of the given width'''
+
+        return wrap(self.chunks(gi), width)
+
+
+def wrap(chunks, width=80):
+    '''Yields sequence chunks as blocks of newline terminated lines of the given width'''
+
+    carry = ''
+    for seq in chunks:
+        seq = carry + seq if carry else seq
+        stop = len(seq) - len(seq) % width
+        if stop:
+            yield '\n'.join(seq[i:i + width] for i in xrange(0, stop, width)) + '\n'
+        carry = seq[stop:]
+
+    if carry:
+        yield carry + '\n'
+
+
+def migrate_genome(store, gi, encoding, chunk_size, drop):
+    '''
+    Copies the GridFS sequence of a genome into the sequence store. Genomes already stored
+    in full are skipped, the chunks of a genome an interrupted run left short are replaced.
+    '''
+    global counter
+
+    if not store.fs.exists(filename=str(gi)):
+        return
+
+    grid_out = store.fs.get_last_version(str(gi))
+    stored = store.length(gi)
+    if stored == grid_out.length:
+        return
+    if stored:
+        logger.warning('Genome {0} has {1} of {2} bases stored, migrating it again'.format(gi, stored, grid_out.length))
+        store.collection.remove({'genome': int(gi)})
+
+    seq = grid_out.read()
+    store.put(gi, seq, encoding, chunk_size)
+    counter.migrated.next()
+
+    if drop:
+        for grid_out in store.fs.find({'filename': str(gi)}):
+            store.fs.delete(grid_out._id)
+
+
+def summary():
+    '''Logging summary of migrated sequences'''
+
+    # Counter starts at 0, so >it = count(); >print it.next(); >0
+    # Using counter.*.next here sets it to the correct value for printing.
+    genomes = counter.genomes.next()
+    migrated = counter.migrated.next()
+
+    logger.info('{0} Genomes checked, {1} Sequences migrated from GridFS.'.format(genomes, migrated))
+
+
+def main(args):
+    '''Migrates genome sequences stored in 80 byte GridFS chunks into the chunked sequence store'''
+
+    global logger
+
+    logger = args.logging.getLogger(__name__)
+    db = connect(args)
+    store = SequenceStore(db)
+
+    logger.info('Migrating sequences from GridFS ({0} encoding, {1} bases per chunk)...'.format(args.encoding, args.chunk_size))
+    for genome in db.genome.find({}, {'_id': 0, 'gi': 1}, timeout=False):
+        counter.genomes.next()
+        migrate_genome(store, genome['gi'], args.encoding, int(args.chunk_size), args.drop)
+
+    summary()
+
+
+if __name__ == '__main__':
+    print 'This program should be run as part of the capsid package:\n\t$ capsid migrate -h\n\tor\n\t$ /path/to/capsid/bin/capsid migrate -h'
@@ -9,15 +9,19 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import division
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 from functools import partial
+from itertools import imap
 import multiprocessing
 import re
 import sys
 
 from bx.intervals.intersection import Intersecter, Interval
+import numpy
 
 from database import *
+from instrument import stage
+from hits import Hits, load_directory
 
 
 db = None
@@ -44,9 +48,13 @@ def merge(lst):
 
 
 def insert_stats(stats):
-    '''Load sample statistics into the database'''
+    '''Load statistics into the database in batches, returns the number inserted'''
 
-    db.statistics.save(stats)
+    inserted = bulk_insert(db.statistics, (stat for stat in stats if stat), batch_size=1000)
+    # Project statistics read the sample statistics written by the pool workers
+    flush_writes(db)
+
+    return inserted
 
 
 def find_genes(genome):
@@ -174,6 +182,15 @@ def get_common_stats(project, genome_hits_query, gene_hits_query, genome_hits_qu
        gene_hit_count_pathogen = 0
        gene_coverage_avg_pathogen, gene_coverage_max_pathogen = 0, 0 
 
+    return common_stats(project, genome, genome_hit_count, genome_hit_count_pathogen, gene_hit_count, gene_hit_count_pathogen,
+                        genome_coverage_percent, genome_coverage_percent_pathogen, gene_coverage_avg, gene_coverage_avg_pathogen,
+                        gene_coverage_max, gene_coverage_max_pathogen)
+
+
+def common_stats(project, genome, genome_hit_count, genome_hit_count_pathogen, gene_hit_count, gene_hit_count_pathogen,
+                 genome_coverage_percent, genome_coverage_percent_pathogen, gene_coverage_avg, gene_coverage_avg_pathogen,
+                 gene_coverage_max, gene_coverage_max_pathogen):
+    '''The coverage statistics document common to projects, samples and alignments'''
 
     stats = {
         "accession": genome['accession']
@@ -201,6 +218,71 @@ def get_common_stats(project, genome_hits_query, gene_hits_query, genome_hits_qu
     return stats
 
 
+def merge_arrays(starts, ends):
+    '''merge for arrays of hits, returns the starts and ends of the merged hits in order'''
+
+    low, high = numpy.minimum(starts, ends), numpy.maximum(starts, ends)
+    order = numpy.lexsort((high, low))
+    low, high = low[order], high[order]
+    if not len(low):
+        return low, high
+
+    # A hit starts a new merged hit when it begins after the end of every hit before it
+    reach = numpy.maximum.accumulate(high)
+    first = numpy.flatnonzero(numpy.concatenate(([True], low[1:] > reach[:-1])))
+
+    return low[first], numpy.maximum.reduceat(high, first)
+
+
+def array_gene_coverage(starts, ends, genes):
+    '''gene_coverage of merged hits, genes are the arrays of the gene starts and ends'''
+
+    gene_starts, gene_ends = genes
+    if not len(gene_starts):
+        return 0.0, 0.0
+
+    covered = numpy.zeros(len(gene_starts), numpy.int64)
+    if len(starts):
+        lengths = numpy.concatenate(([0], numpy.cumsum(ends - starts + 1)))
+        # The hits Intersecter.find returns for a gene, start < gene end and end > gene start
+        first = numpy.searchsorted(ends, gene_starts, 'right')
+        last = numpy.searchsorted(starts, gene_ends, 'left')
+        found = last > first
+        first, last = first[found], last[found]
+        # Then the first and last hits are clipped to the gene
+        covered[found] = (lengths[last] - lengths[first] - numpy.maximum(0, gene_starts[found] - starts[first])
+                          - numpy.maximum(0, ends[last - 1] - gene_ends[found]))
+
+    coverage = (covered / (gene_ends - gene_starts + 1)).tolist()
+
+    return sum(coverage) / len(coverage), max(coverage)
+
+
+def array_common_stats(project, genome, hits, genes):
+    '''get_common_stats from the hits of a sidecar on a genome'''
+
+    def coverage(hits):
+        starts, ends = merge_arrays(hits.start, hits.end)
+        gene_hits = hits.select(hits.maps_gene)
+        gene_starts, gene_ends = merge_arrays(gene_hits.start, gene_hits.end)
+        gene_coverage_avg, gene_coverage_max = array_gene_coverage(gene_starts, gene_ends, genes)
+        return (len(hits), len(gene_hits), int((ends - starts + 1).sum()) / genome['length'],
+                gene_coverage_avg, gene_coverage_max)
+
+    genome_hit_count, gene_hit_count, genome_coverage_percent, gene_coverage_avg, gene_coverage_max = coverage(hits)
+
+    pathogen = hits.select(~hits.is_ref)
+    if len(pathogen):
+        genome_hit_count_pathogen, gene_hit_count_pathogen, genome_coverage_percent_pathogen, gene_coverage_avg_pathogen, gene_coverage_max_pathogen = coverage(pathogen)
+    else:
+        genome_hit_count_pathogen = genome_coverage_percent_pathogen = gene_hit_count_pathogen = 0
+        gene_coverage_avg_pathogen, gene_coverage_max_pathogen = 0, 0
+
+    return common_stats(project, genome, genome_hit_count, genome_hit_count_pathogen, gene_hit_count, gene_hit_count_pathogen,
+                        genome_coverage_percent, genome_coverage_percent_pathogen, gene_coverage_avg, gene_coverage_avg_pathogen,
+                        gene_coverage_max, gene_coverage_max_pathogen)
+
+
 def filter_stats(stats):
     '''
     Adds filtering tags to the statistics object. These are in a filters array element,
@@ -322,8 +404,7 @@ def project_statistics(project):
 
     project_stats = (build_project_stats(project, genome) for genome in genomes)
 
-    #map(insert_stats, filter(None, project_stats))
-    [insert_stats(stat) for stat in project_stats if stat]
+    return insert_stats(project_stats)
 
 
 def sample_statistics(sample, project):
@@ -333,8 +414,7 @@ def sample_statistics(sample, project):
     genomes = db.genome.find({}, timeout=False);
     sample_stats = (build_sample_stats(project, sample, genome) for genome in genomes)
 
-    #map(insert_stats, filter(None, sample_stats))
-    [insert_stats(stat) for stat in sample_stats if stat]
+    return insert_stats(sample_stats)
 
 
 
@@ -345,34 +425,133 @@ def alignment_statistics(alignment, project):
     genomes = db.genome.find({}, timeout=False);
     alignment_stats = (build_alignment_stats(project, alignment, genome) for genome in genomes)
 
-    #map(insert_stats, filter(None, sample_stats))
-    [insert_stats(stat) for stat in alignment_stats if stat]
+    return insert_stats(alignment_stats)
+
+
 
+def init_worker(args):
+    '''Gives each pool worker its own MongoDB client, the one inherited through fork is not safe to share'''
 
+    global db
 
-def generate_statistics(project):
-    '''Generates the statistics for the project and all samples under it'''
+    db = connect(args)
+
+
+def generate_statistics(project, args, sample_ids=None):
+    '''Generates the statistics for the project and all samples under it, or only those in sample_ids'''
     logger.info('Calculating statistics for project: {0}'.format(project['name']))
 
     logger.debug('Remove old statistics for the project: {0}'.format(project['label']))
-    db.statistics.remove({'projectId': project['_id']})
-
-    samples = db.sample.find({"projectId": project['_id']})
+    samples_query = {"projectId": project['_id']}
+    alignments_query = {"projectId": project['_id']}
+    old = {'projectId': project['_id']}
+    if sample_ids is not None:
+        # The statistics of the other samples stay, those of the project cover them too
+        samples_query['_id'] = {'$in': sample_ids}
+        alignments_query['sampleId'] = {'$in': sample_ids}
+        old['$or'] = [{'sampleId': {'$in': sample_ids}}, {'ownerType': 'project'}]
+    db.statistics.remove(old)
+    inserted = db.statistics.find({'projectId': project['_id']}).count() if sample_ids is not None and fast_load() else 0
+
+    samples = db.sample.find(samples_query)
     logger.info("Found samples: {0}".format(samples))
 
-    alignments = db.alignment.find({"projectId": project['_id']})
+    alignments = db.alignment.find(alignments_query)
     logger.info("Found alignments: {0}".format(alignments))
 
     pool_size = multiprocessing.cpu_count()
-    pool = multiprocessing.Pool(pool_size)
+    pool = multiprocessing.Pool(pool_size, initializer=init_worker, initargs=(args,))
 
     p_statistics = partial(sample_statistics, project=project)
     a_statistics = partial(alignment_statistics, project=project)
 
-    pool.map(p_statistics, samples)
-    pool.map(a_statistics, alignments)
+    with stage('sample stats', logger, 'statistics') as s:
+        s.add(sum(pool.map(p_statistics, samples)))
+    inserted += s.count
+    with stage('alignment stats', logger, 'statistics') as s:
+        s.add(sum(pool.map(a_statistics, alignments)))
+    inserted += s.count
+    pool.close()
+    pool.join()
     #map(p_statistics, samples)
-    project_statistics(project)
+    with stage('per-genome stats', logger, 'statistics') as s:
+        s.add(project_statistics(project))
+    inserted += s.count
+
+    verify_count(logger, db.statistics, {'projectId': project['_id']}, inserted)
+
+
+def sidecar_statistics(project, sidecars):
+    '''
+    Generates the statistics for the project and all samples under it from the hit sidecars
+    of its alignments, instead of the mapped collection. Returns the genomes each sample hits.
+    '''
+    logger.info('Calculating statistics for project from sidecars: {0}'.format(project['name']))
+
+    alignments = list(db.alignment.find({"projectId": project['_id']}))
+    missing = [alignment['name'] for alignment in alignments if alignment['_id'] not in sidecars]
+    if missing:
+        logger.error('Error: No sidecar for alignments {0} of project {1}. Exiting from statistics'.format(', '.join(missing), project['label']))
+        sys.exit(1)
+    samples = list(db.sample.find({"projectId": project['_id']}))
+
+    alignment_hits = dict((alignment['_id'], sidecars[alignment['_id']][1]) for alignment in alignments)
+    sample_hits = dict((sample['_id'], Hits.concat(alignment_hits[alignment['_id']] for alignment in alignments
+                                                   if alignment['sampleId'] == sample['_id']))
+                       for sample in samples)
+    project_hits = Hits.concat(alignment_hits.itervalues())
+
+    gis = [int(gi) for gi in project_hits.genomes]
+    genomes = dict((genome['gi'], genome) for genome in db.genome.find({'gi': {'$in': gis}}))
+    gene_lists = defaultdict(lambda: ([], []))
+    for gene in db.feature.find({"type": "gene", "genome": {'$in': gis}}, {"_id": 0, "genome": 1, "start": 1, "end": 1}):
+        gene_lists[gene['genome']][0].append(gene['start'])
+        gene_lists[gene['genome']][1].append(gene['end'])
+    genes = dict((gi, (numpy.array(starts, numpy.int64), numpy.array(ends, numpy.int64)))
+                 for gi, (starts, ends) in gene_lists.iteritems())
+    no_genes = (numpy.empty(0, numpy.int64), numpy.empty(0, numpy.int64))
+
+    # The project statistics take the highest gene coverage of the samples and alignments
+    coverage_max = defaultdict(list)
+
+    def owner_stats(hits, **owner):
+        for gi, genome_hits in hits.by_genome():
+            if gi not in genomes:
+                continue
+            stats = array_common_stats(project, genomes[gi], genome_hits, genes.get(gi, no_genes))
+            stats.update(owner)
+            if 'sampleId' in owner:
+                coverage_max[gi].append((stats['geneCoverageMax'], stats['pathgeneCoverageMax']))
+            yield stats
+
+    logger.debug('Remove old statistics for the project: {0}'.format(project['label']))
+    db.statistics.remove({'projectId': project['_id']})
+
+    with stage('sample stats', logger, 'statistics') as s:
+        for sample in samples:
+            s.add(insert_stats(imap(filter_stats, owner_stats(sample_hits[sample['_id']], ownerType="sample", ownerId=sample['_id'],
+                                                              sample=sample['name'], sampleId=sample['_id']))))
+    inserted = s.count
+    with stage('alignment stats', logger, 'statistics') as s:
+        for alignment in alignments:
+            s.add(insert_stats(imap(filter_stats, owner_stats(alignment_hits[alignment['_id']], ownerType="alignment", ownerId=alignment['_id'],
+                                                              sample=alignment['sample'], sampleId=alignment['sampleId'],
+                                                              alignment=alignment['name'], alignmentId=alignment['_id']))))
+    inserted += s.count
+
+    def project_stats():
+        for stats in owner_stats(project_hits, ownerType="project", ownerId=project['_id']):
+            stats["geneCoverageMax"] = max(cover for cover, path_cover in coverage_max[stats['gi']])
+            stats["pathgeneCoverageMax"] = max(path_cover for cover, path_cover in coverage_max[stats['gi']])
+            yield filter_stats(stats)
+
+    with stage('per-genome stats', logger, 'statistics') as s:
+        s.add(insert_stats(project_stats()))
+    inserted += s.count
+
+    verify_count(logger, db.statistics, {'projectId': project['_id']}, inserted)
+
+    return dict((sample['_id'], sample_hits[sample['_id']].genomes) for sample in samples)
 
 
 def update_sample_count(genome):
@@ -381,6 +560,47 @@ def update_sample_count(genome):
     db.genome.update({'gi': genome['gi']}, {'$set': {'samples': s, 'sampleCount': len(s)}})
 
 
+def update_sidecar_sample_counts(sample_genomes):
+    '''
+    Updates the sample counts from the genomes each sample of the sidecars hits, without the
+    mapped collection. Only the genomes these samples hit now or hit before are updated, the
+    samples of other projects they list are kept.
+    '''
+
+    hit_by = defaultdict(set)
+    for sample_id, gis in sample_genomes.iteritems():
+        for gi in gis:
+            hit_by[int(gi)].add(sample_id)
+    processed = set(sample_genomes)
+
+    genomes = db.genome.find({'$or': [{'gi': {'$in': hit_by.keys()}}, {'samples': {'$in': list(processed)}}]},
+                             {'_id': 0, 'gi': 1, 'samples': 1})
+    with stage('update sample counts', logger, 'genomes') as s:
+        for genome in s.meter(genomes):
+            samples = [sample for sample in genome.get('samples', []) if sample not in processed] + sorted(hit_by.get(genome['gi'], []))
+            db.genome.update({'gi': genome['gi']}, {'$set': {'samples': samples, 'sampleCount': len(samples)}})
+
+
+def update_samples(args, sample_ids):
+    '''
+    Recalculates the statistics of some samples and their alignments, of their projects, and
+    the sample counts of the genomes they hit, without going over the other samples.
+    '''
+
+    global db, logger, filter_bg
+
+    logger = args.logging.getLogger(__name__)
+    db = connect(args)
+    filter_bg = False
+
+    projects = list(db.project.find({'_id': {'$in': db.sample.find({'_id': {'$in': sample_ids}}).distinct('projectId')}}))
+    [generate_statistics(project, args, sample_ids) for project in projects]
+
+    genomes = db.mapped.find({'sampleId': {'$in': sample_ids}}).distinct('genome')
+    with stage('update sample counts', logger, 'genomes') as s:
+        map(update_sample_count, s.meter({'gi': gi} for gi in genomes))
+
+
 def main(args):
     '''Calculate Genome Coverage Statistics'''
 
@@ -443,12 +663,24 @@ def main(args):
                 sys.exit(1)  
 
     #projects = list(db.project.find({'label': {'$in': args.projects}}))                               
-    map(generate_statistics, projects)
+    if args.from_sidecar:
+        sidecars = load_directory(args.from_sidecar)
+        logger.info('Found {0} sidecars in {1}'.format(len(sidecars), args.from_sidecar))
+        sample_genomes = {}
+        [sample_genomes.update(sidecar_statistics(project, sidecars)) for project in projects]
+
+        logger.info('Updating Genome collection to show which samples hit the genome...')
+        update_sidecar_sample_counts(sample_genomes)
+        logger.info('Done.')
+        return
+
+    [generate_statistics(project, args) for project in projects]
 
     # Updating Genomes with the number of sample hits
     logger.info('Updating Genome collection to show which samples hit the genome...')
     genomes = db.genome.find({}, {'_id': 0, 'gi': 1})
-    map(update_sample_count, genomes)
+    with stage('update sample counts', logger, 'genomes') as s:
+        map(update_sample_count, s.meter(genomes))
     logger.info('Done.')
 
 if __name__ == '__main__':
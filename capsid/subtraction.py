@@ -13,9 +13,10 @@
 from __future__ import division
 from itertools import count, ifilter, imap
 from collections import namedtuple
-from functools import partial
 import re
 import os, sys
+import errno
+import gzip
 import subprocess
 import csv
 
@@ -23,6 +24,10 @@ import pysam
 from bx.intervals.intersection import Intersecter, Interval
 
 from database import *
+from instrument import stage
+from bgzf import BgzfWriter
+from mapped import encode as encode_mapped
+from hits import HitCollector
 import alignment
 
 
@@ -40,6 +45,28 @@ genomes = {}
 counter = Counter(count(), count(), count(), count())
 regex = re.compile("gi\|(.+?)($|\|)|ref\|(.+?)(\.|$|\|)")
 temp = None
+compact = False
+sidecar = None
+
+# Bytes of FASTQ records held before they are written to an unmapped reads file
+UNMAPPED_BUFFER = 1 << 20
+
+# BAM flag bits
+PAIRED = 0x1
+PROPER_PAIR = 0x2
+UNMAPPED = 0x4
+MATE_UNMAPPED = 0x8
+
+
+def valid_flag(flag):
+    '''Valid single-end or pair-end alignment, from the flag bits alone'''
+    if flag & PAIRED:
+        return flag & (PROPER_PAIR | UNMAPPED | MATE_UNMAPPED) == PROPER_PAIR
+    else:
+        return not flag & UNMAPPED
+
+# valid_flag of the four lowest flag bits, the only ones it looks at
+VALID = [valid_flag(flag) for flag in xrange(16)]
 
 
 def check_align(args):
@@ -74,10 +101,133 @@ def update_isref(readId):
                      {'$set': {'isRef': 1}}, False, False, False, True)
 
 
+class FastqWriter(object):
+    '''Buffered FASTQ output, plain or compressed with gzip or bgzip'''
+
+    def __init__(self, path, compress=None):
+        self.path = path
+        if compress == 'bgzip':
+            self.fh = BgzfWriter(path)
+        elif compress == 'gzip':
+            self.fh = gzip.open(path, 'wb', 6)
+        else:
+            self.fh = open(path, 'wb')
+        self.parts = []
+        self.size = 0
+
+    def write(self, record):
+        self.parts.append(record)
+        self.size += len(record)
+        if self.size >= UNMAPPED_BUFFER:
+            self.flush()
+
+    def flush(self):
+        self.fh.write(''.join(self.parts))
+        self.parts = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+
+
+class UnmappedWriter(object):
+    '''
+    Writes the unmapped reads to <alignment>.unmapped.fastq, or with split pairs, the mates
+    of paired reads to <alignment>.unmapped_1.fastq and _2.fastq. A mate waits until the other
+    one is found so both files list the pairs in the same order, mates whose other read is
+    never found and single end reads go to <alignment>.unmapped.fastq.
+
+    With a quality threshold the reads are filtered as capsid qfilter filters them, a read
+    passes with at most limit bases under the threshold and a pair when either mate passes.
+    The files are then named as qfilter names its output, <alignment>.unmapped.quality.fastq.
+    '''
+
+    def __init__(self, directory, name, compress=None, split_pairs=True, threshold=None, limit=3):
+        extension = ('.quality' if threshold is not None else '') + ('.fastq.gz' if compress else '.fastq')
+        self.split_pairs = split_pairs
+        self.single = FastqWriter(os.path.join(directory, name + '.unmapped' + extension), compress)
+        if split_pairs:
+            self.first = FastqWriter(os.path.join(directory, name + '.unmapped_1' + extension), compress)
+            self.second = FastqWriter(os.path.join(directory, name + '.unmapped_2' + extension), compress)
+        self.mates = {}
+        self.pairs = 0
+
+        # Sanger quality characters under the threshold
+        self.low = None if threshold is None else ''.join(chr(q + 33) for q in xrange(int(threshold)))
+        self.limit = int(limit)
+        self.filtered = 0
+
+    def passes(self, align):
+        if self.low is None:
+            return True
+
+        # qfilter checks the qualities against the sequence written, without soft clips
+        qual = align.qqual
+        if not qual or len(qual) != len(align.query):
+            return False
+        return len(qual) - len(qual.translate(None, self.low)) <= self.limit
+
+    def write_single(self, record, passed):
+        if passed:
+            self.single.write(record)
+        else:
+            self.filtered += 1
+
+    def write(self, align):
+        # Secondary and supplementary alignments repeat a read that has its primary alignment
+        if align.is_secondary or align.is_supplementary:
+            return
+
+        record = fastq_record(align)
+
+        if not self.split_pairs or not align.is_paired:
+            self.write_single(record, self.passes(align))
+            return
+
+        passed = self.passes(align)
+        mate = self.mates.pop(align.qname, None)
+        if mate is None:
+            self.mates[align.qname] = (align.is_read1, record, passed)
+        elif mate[0] == align.is_read1:
+            # Not a mate after all, keep the one found last
+            self.write_single(mate[1], mate[2])
+            self.mates[align.qname] = (align.is_read1, record, passed)
+        elif passed or mate[2]:
+            first, second = (record, mate[1]) if align.is_read1 else (mate[1], record)
+            self.first.write(first)
+            self.second.write(second)
+            self.pairs += 1
+        else:
+            self.filtered += 2
+
+    def close(self):
+        '''Writes the mates left without their pair to the single reads file and closes the files'''
+
+        for is_read1, record, passed in self.mates.itervalues():
+            self.write_single(record, passed)
+        orphans = len(self.mates)
+        self.mates = {}
+
+        files = [self.single] + ([self.first, self.second] if self.split_pairs else [])
+        for fastq in files:
+            fastq.close()
+
+        if self.split_pairs:
+            logger.info('Unmapped pairs written to {0} and {1}: {2}, mates without their pair: {3}'.format(
+                    self.first.path, self.second.path, self.pairs, orphans))
+        if self.low is not None:
+            logger.info('Unmapped reads left out by the quality filter: {0}'.format(self.filtered))
+
+
+def fastq_record(align):
+    # here align.qname should be extracted in its original form i.e. with /1 and /2 if they exist 
+    return '@' + align.qname + '\n' + str(align.query) + '\n+\n' + str(align.qqual) + '\n'
+
+
 def extract_unmapped(align, fastq):
     """Output unmapped alignments to Fastq file"""
-    # here align.qname should be extracted in its original form i.e. with /1 and /2 if they exist 
-    fastq.write("@{0:>s}\n{1:>s}\n+\n{2:>s}\n".format(str(align.qname), str(align.query), str(align.qqual)))
+    fastq.write(align)
 
 
 # new 
@@ -177,11 +327,21 @@ def maps_gene(mapped):
     return intersecter.find(mapped['refStart'], mapped['refEnd'])
 
 
-def build_mapped(align, genome, reference):
+def build_mapped(align, genome, reference, readid=None):
     '''Generates dict for mapped alignments'''
 
+    # Each pysam attribute decodes the record again, so each is read once
+    qqual = align.qqual
+    pos = align.pos
+    qlen = align.qlen
+    rlen = align.rlen
+    alen = align.alen
+    aend = align.aend
+    tags = dict(align.tags)
+
     # Since align.qqual is in Sanger format. 
-    scores = [ord(m)-33 for m in align.qqual]
+    scores = bytearray(qqual)
+    offset = 33 * len(scores)
 
     #if align.is_proper_pair:
         #align_length = align.isize
@@ -192,52 +352,44 @@ def build_mapped(align, genome, reference):
     #    ref_end = align.aend or align.pos + align_length + 1
 
 
-    if align.alen is None:
-        align_length = align.pos + align.qlen + 1        
+    if alen is None:
+        align_length = pos + qlen + 1        
     else:
-        align_length = align.alen 
+        align_length = alen 
         
 
-    if align.aend is None:
-        ref_end = align.pos + align.qlen + 1
+    if aend is None:
+        ref_end = pos + qlen + 1
     else:
-        ref_end = align.aend
+        ref_end = aend
 
  
-    try:
-        MD = align.opt('MD')
+    MD = tags.get('MD')
+    if MD is not None:
         mismatch = len(re.findall("\D", MD))
-    except KeyError:
-        MD = None
-        try: mismatch = int(align.rlen)
+    else:
+        try: mismatch = int(rlen)
         except TypeError:
             logger.debug(align)
             logger.error('Aligned read with null length')
             exit()
 
-    try:
-        AS = int(align.opt('AS'))
-    except KeyError:
-        AS = None
-
-    try:
-        PG = align.opt('PG')
-    except KeyError:
-        PG = None
+    AS = int(tags['AS']) if 'AS' in tags else None
+    PG = tags.get('PG')
 
     mapped = {
        # take only the read identifier exclude /1 and /2 
-       "readId": align.qname.split("/")[0]
+       "readId": readid or align.qname.split("/")[0]
        , "refStrand": -1 if align.is_reverse else 1
-       , "refStart": int(align.pos) + 1 # pysam is 0-based index
+       , "refStart": int(pos) + 1 # pysam is 0-based index
        , "refEnd": int(ref_end)
        , "alignLength": int(align_length)
-       , "readLength": int(align.rlen)  # Total Length of the read
+       , "readLength": int(rlen)  # Total Length of the read
        , "mapq": int(align.mapq)
-       , "minQual": min(scores)
-       , "avgQual": sum(scores) / len(scores)
-       , "qqual": align.qqual
-       , "miscalls": align.qqual.count('.')
+       , "minQual": min(scores) - 33
+       , "avgQual": (sum(scores) - offset) / len(scores)
+       , "qqual": qqual
+       , "miscalls": qqual.count('.')
        , "mismatch": mismatch
        , "pairEnd": 1 if align.is_proper_pair else 0
        , "genome": int(genome)
@@ -265,7 +417,7 @@ def build_mapped(align, genome, reference):
     if reference:
         mapped['isRef'] = 1
 
-    return mapped
+    return encode_mapped(mapped) if compact else mapped
 
 
 def get_genome(gid):
@@ -330,38 +482,45 @@ def determine_genome(genome_header):
     return genome
 
 
-def insert_mapped(mapped, process):
-    '''Insert mapped alignments into Database'''
+def insert_mapped(mapped_alignments, process):
+    '''Insert mapped alignments into Database in batches, returns the set of read ids and the number inserted'''
     # If it maps to a genome save in the database, otherwise
     # just return the intersecting read id
-    # new do not insert into mongo right now
-    if mapped['genome'] and process in ['both', 'mapped']:
-        db.mapped.insert(mapped)
-    
-    return mapped['readId']
+    readids = set()
+
+    def saved():
+        for mapped in mapped_alignments:
+            readids.add(mapped['readId'])
+            if mapped['genome'] and process in ['both', 'mapped']:
+                if sidecar is not None:
+                    sidecar.add(mapped)
+                yield mapped
+
+    inserted = bulk_insert(db.mapped, saved(), batch_size=1000)
+
+    return readids, inserted
 
 
 def valid_mapped(align):
     '''Returns true if valid single-end or pair-end alignment'''
     #return (not align.is_proper_pair or align.is_proper_pair and align.isize) and not align.is_unmapped
-    if align.is_paired:
-        return (align.is_proper_pair and not align.mate_is_unmapped and not align.is_unmapped)
-    else:
-        return (not align.is_unmapped)
+    return VALID[align.flag & 0xf]
 
 
-def extract_mapped(align, bamfile, sam_file, reference=False):
+def extract_mapped(align, bamfile, sam_file, reference=False, readid=None):
     '''Process mapped alignment and return dict'''
     global genomes
 
-    if (0 <= align.mapq <= 3 or align.mapq >= mapq) and valid_mapped(align):
+    quality = align.mapq
+    if (0 <= quality <= 3 or quality >= mapq) and VALID[align.flag & 0xf]:
+        rname = str(bamfile.getrname(align.tid))
         if gra and sam_file: 
           try:  
               #genome_sam = str(bamfile.getrname(align.tid))                                                                           
               #extract_mapped_sam(align,genome_sam,sam_file)   
-              genome_sam = get_genome_gra(genomes[str(bamfile.getrname(align.tid))])   
+              genome_sam = get_genome_gra(genomes[rname])   
           except KeyError:
-              genome_sam = str(bamfile.getrname(align.tid))       
+              genome_sam = rname       
           except ValueError:
               pass
           else:
@@ -369,10 +528,10 @@ def extract_mapped(align, bamfile, sam_file, reference=False):
                   extract_mapped_sam(align,genome_sam,sam_file)
 
         try:
-            genome = genomes[str(bamfile.getrname(align.tid))]
+            genome = genomes[rname]
         except KeyError:
-            genome = determine_genome(bamfile.getrname(align.tid))
-            if genome: genomes[str(bamfile.getrname(align.tid))] = genome
+            genome = determine_genome(rname)
+            if genome: genomes[rname] = genome
         except ValueError:     
             genome = False
             pass
@@ -382,9 +541,9 @@ def extract_mapped(align, bamfile, sam_file, reference=False):
         # a junction and just save as an intersecting readId
         if genome:
             counter.ref_mapped.next() if reference else counter.xeno_mapped.next()
-            mapped = build_mapped(align, genome, reference)
+            mapped = build_mapped(align, genome, reference, readid)
         else:
-            mapped = {'readId': align.qname.split("/")[0], 'genome': None}
+            mapped = {'readId': readid or align.qname.split("/")[0], 'genome': None}
 
         return mapped
 
@@ -395,24 +554,32 @@ def maps_xeno(align, readids):
 
 
 def extract_alignment(align, bamfile, readids, fastq, hgids):
-    '''Process alignments '''
+    '''
+    Process alignments. Most reference alignments are skipped on their flag and read id, the
+    rest of the record is only decoded for those written or stored.
+    '''
+
+    valid = VALID[align.flag & 0xf]
+    if not valid and not fastq:
+        return None
 
-    in_xeno = maps_xeno(align, readids)
+    readid = align.qname.split("/")[0]
+    in_xeno = readid in readids
 
     #if align.is_unmapped and not in_xeno and fastq:
-    if not valid_mapped(align) and not in_xeno and fastq:
+    if not valid and not in_xeno:
         counter.ref_unmapped.next()
         extract_unmapped(align, fastq)
     #elif not align.is_unmapped and in_xeno:
-    elif valid_mapped(align) and in_xeno:
+    elif valid and in_xeno:
         if gra and hgids:
             # i.e map to both pathogen and human ref
             extract_hg_readIds(align,hgids)
-        return extract_mapped(align, bamfile, False, True)
+        return extract_mapped(align, bamfile, False, True, readid)
 
 
-def parse_ref(args, readids, process):
-    '''Extract alignments from Reference BAM file'''
+def parse_ref(args, readids, process, fastq):
+    '''Extract alignments from Reference BAM file, unmapped reads are written to fastq'''
     global genomes
 
     if args.lookup.ref.file: genome_lookup(args.lookup.ref)
@@ -422,8 +589,6 @@ def parse_ref(args, readids, process):
 
     bamfile = pysam.Samfile(args.ref, 'rb')
 
-    fastq = open(meta.alignment['name'] + '.unmapped.fastq', 'w') if process in ['both', 'unmapped'] else None
-
     if args.gra:
         hgids = open(temp + meta.alignment['name'] + '.hg.mapped.txt', 'a') if process in ['both', 'mapped'] else None
         return ifilter(None, (extract_alignment(align, bamfile, readids, fastq, hgids)
@@ -478,9 +643,21 @@ def summary(xeno_mapped_readids, intersecting_mapped_readids, process):
         logger.info('Unmapped alignments found in Reference BAM file: {0}'.format(ref_unmapped))
 
 
+def unmapped_writer(args):
+    '''Opens the unmapped reads files of the alignment in --unmapped-dir'''
+
+    try:
+        os.makedirs(args.unmapped_dir)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    return UnmappedWriter(args.unmapped_dir, meta.alignment['name'], args.compress, not args.interleave, args.threshold, args.limit)
+
+
 def main(args):
     ''' '''
-    global db, logger, meta, mapq, temp, gra
+    global db, logger, meta, mapq, temp, gra, compact, sidecar
     logger = args.logging.getLogger(__name__)
 
     if args.lookup:
@@ -496,29 +673,53 @@ def main(args):
     process = args.process
     temp = args.temp
     gra = args.gra
-
-    p_mapped = partial(insert_mapped, process=process)
+    compact = args.compact
+    sidecar = HitCollector() if args.sidecar and process != 'unmapped' else None
+    if args.sidecar and sidecar is None:
+        logger.warning('No mapped reads are loaded with -p unmapped, no sidecar is written')
+
+    # Unacknowledged writes are checked against a count of the alignment's documents at the end
+    existing = db.mapped.find({'alignmentId': meta.alignment['_id']}).count() if fast_load() or sidecar is not None else 0
+
+    # A sidecar only holds the reads of the run that writes it
+    if sidecar is not None and existing:
+        logger.error('Alignment {0} already has {1} mapped reads, its sidecar would not include them. '
+                     'Remove them first or run without --sidecar.'.format(args.align, existing))
+        sys.exit(1)
 
     xeno_mapped = parse_xeno(args,process)
     if process in ['both', 'mapped']:
         logger.info('Inserting mapped alignments from Xeno BAM file...')
-    xeno_mapped_readids = set(map(p_mapped, xeno_mapped))
+    with stage('parse xeno BAM and insert mapped', logger, 'alignments') as s:
+        xeno_mapped_readids, xeno_inserted = insert_mapped(s.meter(xeno_mapped), process)
 
-    ref_mapped = parse_ref(args, xeno_mapped_readids, process)
+    fastq = unmapped_writer(args) if process in ['both', 'unmapped'] else None
+    ref_mapped = parse_ref(args, xeno_mapped_readids, process, fastq)
     if process == 'mapped':
         logger.info('Inserting mapped alignments from Reference BAM file...')
     elif process == 'unmapped':
         logger.info('Outputting unmapped alignments from Reference BAM file...')
     else:
         logger.info('Inserting mapped and outputting unmapped from Reference BAM file...')
-    intersecting_mapped_readids = set(map(p_mapped, ref_mapped))
+    with stage('parse reference BAM and insert mapped', logger, 'alignments') as s:
+        intersecting_mapped_readids, ref_inserted = insert_mapped(s.meter(ref_mapped), process)
+    if fastq:
+        fastq.close()
 
     if args.gra:
         logger.info('Outputting the set of reads mapping to Xeno only for GRA calculation')
         get_only_xeno_reads(meta.alignment['name'] + '.vg.mapped.sam', meta.alignment['name'] + '.hg.mapped.txt', args) if process in ['both', 'mapped'] else None
 
     logger.info('Updating reads that map in both Xeno and Reference...')
-    map(update_isref, intersecting_mapped_readids)
+    with stage('update isRef', logger, 'reads') as s:
+        map(update_isref, s.meter(intersecting_mapped_readids))
+    verify_count(logger, db.mapped, {'alignmentId': meta.alignment['_id']}, existing + xeno_inserted + ref_inserted)
+
+    if sidecar is not None:
+        with stage('write sidecar', logger, 'hits') as s:
+            path = sidecar.write(args.sidecar, meta, intersecting_mapped_readids)
+            s.add(len(sidecar.readids))
+        logger.info('Hits written to {0}'.format(path))
 
     summary(xeno_mapped_readids, intersecting_mapped_readids, process)
 
@@ -10,11 +10,18 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import namedtuple, defaultdict
+import numpy
 import pymongo 
 import os.path
 import subprocess
+import time
 
 from database import *
+from instrument import stage
+import lineage
+
+Tree = namedtuple('Tree', ['parents', 'ranks', 'left', 'right'])
 
 db = None
 fs = None
@@ -30,7 +37,7 @@ def main(args):
     logger = args.logging.getLogger(__name__)
     db = connect(args)
 
-    load_taxonomy(args.directory, args.repair)
+    load_taxonomy(args.directory, args.repair, args.snapshot)
 
 
 def load_taxonomy_names(name_file):  
@@ -66,149 +73,254 @@ def load_taxonomy_names(name_file):
     return SciNameDict, ComNameDict
 
 
-def load_taxonomy_data(name_file, node_file):
+def load_taxonomy_nodes(node_file):
     '''
-    Loads NCBI taxonomy node data into MongoDB in the taxa collection.
+    Reads NCBI taxonomy nodes into a dict of parents and a dict of ranks keyed by taxID,
+    plus the children of each taxon in file order.
     '''
 
-    SciNameDict, ComNameDict = load_taxonomy_names(name_file)
-
     logger.info("Loading taxonomy nodes: {0}".format(node_file))
 
-    NodesFile = open(node_file)
+    parents = {}
+    ranks = {}
+    children = defaultdict(list)
 
-    for line in NodesFile:
+    for line in open(node_file):
         fields  = line.split('\t|\t')
         taxID   = int(fields[0])
         if int(fields[1]) == 1 and fields[2] == 'no rank':
             first = 0
-            #first = None
         else:
             first = int(fields[1])
+        parents[taxID] = first
+        ranks[taxID] = fields[2]
+        children[first].append(taxID)
+
+    return parents, ranks, children
+
+
+def nested_set(children, root=0):
+    '''
+    Calculates the modified preorder tree traversal left/right values below root.
+    Uses an explicit stack so deep lineages cannot hit the recursion limit.
+    '''
+
+    left, right = {root: 1}, {}
+    value = 1
+    stack = [(root, iter(children.get(root, ())))]
+
+    while stack:
+        node, remaining = stack[-1]
+        child = next(remaining, None)
+        value += 1
+        if child is None:
+            right[node] = value
+            stack.pop()
+        else:
+            left[child] = value
+            stack.append((child, iter(children.get(child, ()))))
+
+    return left, right
+
+
+def taxa_documents(tree, SciNameDict, ComNameDict):
+    '''Yields the taxa collection documents for every node of the tree'''
+
+    for taxID, parent in tree.parents.iteritems():
         SciName = SciNameDict.get(taxID, "<%d>" % taxID)
         NCBIdata = {
             "_id": taxID,  
-            "parent"  : first,  # Parent taxID
-            "rank"    : fields[2], # Taxonomic rank name
+            "parent"  : parent,  # Parent taxID
+            "rank"    : tree.ranks[taxID], # Taxonomic rank name
             "sciName" : SciName,                # Scientific name
             "comName" : ComNameDict.get(taxID, SciName) # Genbank common name
-            #"allNames": AllNamesDict.get(taxID, SciName)   # List of all names
-            #"GenCode" : int(fields[6]),            # Genomic genetic code
-            #"MitCode" : int(fields[8])         # Mitochondrial code
             }
-        db.taxa.update({'_id': taxID},NCBIdata,True)
+        if taxID in tree.left:
+            NCBIdata["left"] = tree.left[taxID]
+            NCBIdata["right"] = tree.right[taxID]
+        yield NCBIdata
+
+
+def load_taxonomy_data(name_file, node_file):
+    '''
+    Builds the NCBI taxonomy tree in memory and bulk loads it into a fresh collection,
+    which then atomically replaces the taxa collection. Returns the tree.
+    '''
 
-    logger.info("Adding parent index")
-    db.taxa.ensure_index('parent')
+    SciNameDict, ComNameDict = load_taxonomy_names(name_file)
+    parents, ranks, children = load_taxonomy_nodes(node_file)
 
     logger.info("Calculating nested set values")
-    update_tree(db.taxa)
+    left, right = nested_set(children)
+    tree = Tree(parents, ranks, left, right)
+
+    logger.info("Inserting {0} taxa".format(len(parents)))
+    db.taxa_load.drop()
+    inserted = bulk_insert(db.taxa_load, taxa_documents(tree, SciNameDict, ComNameDict))
+    verify_count(logger, db.taxa_load, {}, inserted)
+
+    logger.info("Adding parent and left indexes")
+    db.taxa_load.ensure_index('parent')
+    db.taxa_load.ensure_index('left')
+
+    logger.info("Replacing taxa collection")
+    db.taxa_load.rename('taxa', dropTarget=True)
+
+    return tree
 
-    logger.info("Adding left index")
-    db.taxa.ensure_index('left')
+
+def sorted_ids(cursor, key):
+    '''Returns the values of key from a query as a sorted numpy array'''
+
+    return numpy.unique(numpy.fromiter((doc[key] for doc in cursor), numpy.int64))
+
+
+def in_sorted(values, ids):
+    '''Vectorised membership test of values against a sorted array of ids'''
+
+    if not len(ids):
+        return numpy.zeros(len(values), bool)
+
+    index = numpy.searchsorted(ids, values).clip(0, len(ids) - 1)
+    return ids[index] == values
+
+
+def scan_gi_taxid(genome_file, genome_ids, taxon_ids, block_size=64 << 20):
+    '''
+    Scans the GI to taxID dump in large blocks that numpy parses in one call,
+    yielding the (gi, taxid) pairs for genomes we have and taxa we want.
+    '''
+
+    with open(genome_file, 'rb') as fh:
+        carry = ''
+        while True:
+            block = fh.read(block_size)
+            if not block:
+                break
+
+            block = carry + block
+            cut = block.rfind('\n') + 1
+            carry = block[cut:]
+
+            pairs = numpy.fromstring(block[:cut], numpy.int64, sep=' ').reshape(-1, 2)
+            pairs = pairs[in_sorted(pairs[:, 0], genome_ids)]
+            yield pairs[in_sorted(pairs[:, 1], taxon_ids)]
+
+        if carry.strip():
+            pairs = numpy.fromstring(carry, numpy.int64, sep=' ').reshape(-1, 2)
+            pairs = pairs[in_sorted(pairs[:, 0], genome_ids)]
+            yield pairs[in_sorted(pairs[:, 1], taxon_ids)]
+
+
+def gitaxid_documents(pairs):
+    '''Groups (gi, taxid) pairs by taxID into gitaxid documents'''
+
+    pairs = pairs[numpy.argsort(pairs[:, 1], kind='mergesort')]
+    taxa, starts = numpy.unique(pairs[:, 1], return_index=True)
+
+    for taxid, gis in zip(taxa, numpy.split(pairs[:, 0], starts[1:])):
+        yield {'_id': int(taxid), 'gi': sorted(set(int(gi) for gi in gis))}
 
 
 def load_taxonomy_genomes(genome_file):
 
     taxon_viral_full = db.taxa.find({ 'rank': 'superkingdom', 'sciName': 'Viruses'})
 
-    viral = taxon_viral_full[0]
     r = taxon_viral_full[0]['right']
     l = taxon_viral_full[0]['left']
 
     logger.info('Retrieving all the viral taxa')
 
-    viral_taxa_all = []
-    viral_taxa_dict = {}
+    taxon_ids = sorted_ids(db.taxa.find({'left': { '$gt': l }, 'right': { '$lt': r }}, { '_id': 1}), '_id')
+    taxon_ids = taxon_ids[taxon_ids != 0]
 
-    taxon_ids = db.taxa.find( {'left': { '$gt': l }, 'right': { '$lt': r }}, { '_id': 1} )
-    tax_array = []
-    for taxid in taxon_ids:
-        tax_array.append(taxid['_id'])
-        viral_taxa_dict[taxid['_id']] = True
-    viral_taxa_all = viral_taxa_all + tax_array
+    logger.info("Total number of viral taxa: {0}".format(len(taxon_ids)))
 
-    logger.info("Total number of viral taxa: {0}".format(len(viral_taxa_all)))
+    genome_ids = sorted_ids(db.genome.find({}, {'_id': 0, 'gi': 1}), 'gi')
 
-    logger.info("Loading viral genome identifiers")
+    logger.info("Loading viral genome identifiers for {0} genomes".format(len(genome_ids)))
 
-    # We could sort the file, but it's actually a bad idea. That's because the sort 
-    # works on the whole file, which is huge. We are only interested in a subset of
-    # genomes. Also, we switched to use a dict to test for the match, which is 
-    # much faster in this loop. 
-    gi_file = open(genome_file)
+    # The dump has hundreds of millions of lines but we only keep the pairs for
+    # genomes in the database, so everything is filtered in numpy before any
+    # Python objects are made and the documents are built once, in memory.
+    found = list(scan_gi_taxid(genome_file, genome_ids, taxon_ids))
+    pairs = numpy.concatenate(found) if found else numpy.empty((0, 2), numpy.int64)
 
     db.gitaxid.remove()
+    total = bulk_insert(db.gitaxid, gitaxid_documents(pairs))
+    verify_count(logger, db.gitaxid, {}, total)
 
-    list_gi = []
-    current = None
-
-    for line in gi_file:
-        elements = line.split('\t')
-        gi  = int(elements[0])
-        taxid = int(elements[1])
+    logger.info("Finished Loading viral genome identifiers: {0} GIs in {1} taxa".format(len(pairs), total))
 
-        if taxid != 0 and (taxid in viral_taxa_dict):
-            if current == None:
-                current = taxid
 
-            if taxid == current:
-                list_gi.append(gi)   
-            else:
-                db.gitaxid.update({'_id': current}, {'$addToSet': { 'gi': {'$each': list_gi }}}, True)
-                current = taxid
-                list_gi = [gi] 
+def taxa_left(taxon_ids, batch_size=50000):
+    '''Returns a dict of taxID to left value for the given taxa, fetched in a few large queries'''
 
-    db.gitaxid.update({'_id': current}, {'$addToSet': { 'gi': {'$each': list_gi }}}, True)
+    lefts = {}
+    for i in xrange(0, len(taxon_ids), batch_size):
+        for taxon in db.taxa.find({'_id': {'$in': taxon_ids[i:i + batch_size]}}, {'left': 1}):
+            lefts[taxon['_id']] = taxon['left']
 
-    logger.info("Finished Loading viral genome identifiers")
+    return lefts
 
 
-def update_genomes():
+def update_genomes(batch_size=1000):
     '''
     Adds the preorder tree traversal values to the genomes
     '''
 
     logger.info("Calculating nested set values for genomes")
-    genomes = db.gitaxid.find({}, { '_id': 1, 'gi': 1})
-    for genome in genomes:
-        taxon = db.taxa.find_one({'_id': genome['_id']}, {'left': 1})
-        db.genome.update({'gi': {'$in': genome['gi']}}, {'$set': {'left': taxon['left'], 'taxonId': taxon['_id']}}, multi=True)
 
+    gitaxid = list(db.gitaxid.find({}, { '_id': 1, 'gi': 1}))
+    lefts = taxa_left([taxon['_id'] for taxon in gitaxid])
+    present = set(genome['gi'] for genome in db.genome.find({}, {'_id': 0, 'gi': 1}))
 
-def update_tree(collection): 
-    '''
-    Calculates the modified preorder tree traversal for the taxa collection.
-    '''
-    update_node(collection, 0, 1)
+    # All the assignments are worked out in memory, then sent as one unordered
+    # bulk update per batch of taxa rather than a find_one and update per taxon.
+    assignments = [([gi for gi in taxon['gi'] if gi in present], taxon['_id']) for taxon in gitaxid if taxon['_id'] in lefts]
+    assignments = [(gis, taxid) for gis, taxid in assignments if gis]
+    total = sum(len(gis) for gis, taxid in assignments)
 
+    start = time.time()
+    updated = 0
+    for i in xrange(0, len(assignments), batch_size):
+        bulk = db.genome.initialize_unordered_bulk_op()
+        for gis, taxid in assignments[i:i + batch_size]:
+            bulk.find({'gi': {'$in': gis}}).update({'$set': {'left': lefts[taxid], 'taxonId': taxid}})
+            updated += len(gis)
+        bulk.execute()
 
-def update_node(collection, node_id, left):
-    '''
-    Calculates the modified preorder tree traversal for a node in the taxa collection.
-    '''
-    right = left + 1
-    cursor = collection.find({ "parent": node_id }, { '_id': 1})
-    for item in cursor:
-        right = update_node(collection, item['_id'], right) + 1
-    collection.update({'_id': node_id}, {'$set' : { "left" : left, "right" : right}}) 
-    return right
+        elapsed = time.time() - start
+        logger.info("Updated {0} of {1} genomes ({2:.0f} genomes/s)".format(updated, total, updated / elapsed if elapsed else 0))
+
+    assigned = [gi for gis, taxid in assignments for gi in gis]
+    verify_count_in(logger, db.genome, 'gi', assigned, {'taxonId': {'$exists': True}}, total)
 
 
-def load_taxonomy(directory, repair):
+def load_taxonomy(directory, repair, snapshot=None):
     '''
-    Loads NCBI taxonomy data files into MongoDB in the taxa collection.
+    Loads NCBI taxonomy data files into MongoDB in the taxa collection,
+    and writes a snapshot of the tree for capsid.lineage.
     '''
 
     name_file = os.path.join(directory, 'names.dmp')
     node_file = os.path.join(directory, 'nodes.dmp')
 
-    load_taxonomy_data(name_file, node_file)
+    with stage('load taxa', logger, 'taxa') as s:
+        tree = load_taxonomy_data(name_file, node_file)
+        s.add(len(tree.parents))
+
+    snapshot = snapshot or os.path.join(directory, 'taxonomy.snapshot')
+    logger.info("Writing taxonomy snapshot: {0}".format(snapshot))
+    with stage('write snapshot', logger):
+        lineage.write_snapshot(snapshot, tree)
 
     genome_file = os.path.join(directory, 'gi_taxid_nucl.dmp')
-    load_taxonomy_genomes(genome_file)
+    with stage('scan gi_taxid', logger):
+        load_taxonomy_genomes(genome_file)
 
-    update_genomes()
+    with stage('update genomes', logger):
+        update_genomes()
 
 
 if __name__ == '__main__':